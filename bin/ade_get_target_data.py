@@ -121,26 +121,26 @@ def read_file(in_file):
 
 # add assay data from ChEMBL
 
-def chembl_add_assay_info(target_chembl_id, gene_info):
-    mol_field = 'molecule_chembl_id'
-    asy_field = 'assay_chembl_id'
-    if False: # api
-        records = chembl_api.get_bioactivities_for_targets(target_chembl_id)
-    else: # db
-        mol_field = 'molregno'
-        asy_field = 'assay_id'
-        tids_dict = db_chembl.tids_from_chembl_ids(target_chembl_id)
-        tids = list(tids_dict.values())
-        if len(tids) == 1:
-            tids = tids[0]
-        assays = db_chembl.assay_ids_from_tids(tids)
-        #print(tids_dict, tids, assays)
-        #exit()
-        records = list()
-        if assays:
-            records = db_chembl.activities_from_assay_ids(assays)
-        #print(tids, assays)
-        #exit()
+# activity records of a target from the db -- safe to run on several threads.
+# None if any of the lookups failed (an empty list is no activities)
+def chembl_target_records(target_chembl_id):
+    tids_dict = db_chembl.tids_from_chembl_ids(target_chembl_id)
+    if tids_dict == None:
+        return None
+    tids = list(tids_dict.values())
+    if len(tids) == 1:
+        tids = tids[0]
+    assays = db_chembl.assay_ids_from_tids(tids)
+    if assays == None:
+        return None
+    records = list()
+    if assays:
+        records = db_chembl.activities_from_assay_ids(assays)
+    return records
+
+def chembl_add_assay_info(records, gene_info):
+    mol_field = 'molregno'
+    asy_field = 'assay_id'
     gene_info['chembl_results_count'] = len(records)
     counts_asy = dict()
     counts_mol = dict()
@@ -253,7 +253,7 @@ def extract_value(field, data):
 
 #@smart_cache
 # read a json mapping file
-def get_ade_info(in_file, out_file):
+def get_ade_info(in_file, out_file, threads=None):
 
     genes = read_file(in_file)
 
@@ -264,6 +264,8 @@ def get_ade_info(in_file, out_file):
     # cache results
     gene_cache = get_cache()
     gene_data = list()
+    # genes waiting for their ChEMBL activity lookups (done together at the end)
+    chembl_pending = list()
 
     count = 0
     # do the pipeline for the genes
@@ -332,8 +334,8 @@ def get_ade_info(in_file, out_file):
                             c_processed_data = process_chembl_data(g_symbol, c_data)
                             for mapping in data_map['CHEMBL']:
                                 gene_info[mapping['target_field']] = extract_value(mapping['source_field'], c_processed_data)
-                            # get assay info
-                            chembl_add_assay_info(target_chembl_id, gene_info)
+                            # get assay info -- queried in parallel below
+                            chembl_pending.append((gene, gene_info))
                         else:
                             logger.critical("ChEMBL unable to find chembl_id for {}".format(g_symbol))
                     else:
@@ -342,12 +344,27 @@ def get_ade_info(in_file, out_file):
             if len(genes)>10:
                 logger.warning("\r Gene {:3d} of {}".format(count, len(genes)))
 
-            #at the risk of more I/O -- save cache
-            gene_cache[gene] = gene_info
-            save_cache(gene_cache)
+            #at the risk of more I/O -- save cache (genes waiting for their
+            # ChEMBL activities are saved once they have them)
+            if not len(chembl_pending) or chembl_pending[-1][1] is not gene_info:
+                gene_cache[gene] = gene_info
+                save_cache(gene_cache)
         # add to growing list and
         gene_data.append(gene_info)
 
+    # look up the ChEMBL activities of all targets concurrently
+    if len(chembl_pending):
+        target_ids = [gene_info['chembl_target_id'] for (gene, gene_info) in chembl_pending]
+        logger.info("ChEMBL activities for {} targets".format(len(target_ids)))
+        all_records = db_chembl.parallel_queries(chembl_target_records, target_ids, threads)
+        for ((gene, gene_info), records) in zip(chembl_pending, all_records):
+            # a failed lookup is not cached so the next run queries it again
+            if records == None:
+                logger.critical("ChEMBL unable to get activities for {} ... not cached".format(gene))
+                continue
+            chembl_add_assay_info(records, gene_info)
+            gene_cache[gene] = gene_info
+        save_cache(gene_cache)
 
     #
     # either use out_file if defined or stdout otherwise
@@ -379,6 +396,7 @@ if __name__ == "__main__":
         description='compile the ADE target information for a set of genes specified in an file.')
     parser.add_argument('-f', '--file', dest='in_file', help='txt file containing list of gene_symbols', required=True)
     parser.add_argument('-o', '--output', dest='out_file', help='optional output file -- otherwise write to stdout')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=None, help='number of concurrent ChEMBL db queries (default {})'.format(db_chembl._pool_max_))
     parser.add_argument('-v', '--verbose', dest='verbose', action="store_true", default=False,help='turn on addition information that is sent to stderr')
     parser.add_argument('-d', '--debug', dest='debug', action="store_true", default=False,help='turn on debug information (overides versbose) that is sent to stderr')
 
@@ -396,4 +414,4 @@ if __name__ == "__main__":
     # process the out_file argument
     out_file = args.out_file if args.out_file else ""
 
-    get_ade_info(args.in_file, out_file)
+    get_ade_info(args.in_file, out_file, args.threads)
@@ -56,6 +56,29 @@ def read_file(in_file, id_column):
 
     return cpds
 
+# export all activities of the molecules in one query through
+# db_chembl.export_activities (csv or parquet) -- one row per activity with the
+# molecule_chembl_id and all activities columns
+def export_molecule_activities(in_file, id_column, out_file, fmt):
+
+    cpds = read_file(in_file, id_column)
+
+    if not len(cpds):
+        logger.critical("Did not read any molecules from input file {} ... exiting".format(in_file))
+        return
+
+    cpd2molregno = db_chembl.molregnos_from_chembl_ids(cpds)
+    molregnos = list()
+    for molecule_chembl_id in cpds:
+        if molecule_chembl_id not in cpd2molregno:
+            logger.error("Unable to find molregno for molecule_chembl_id: {} .. skipping".format(molecule_chembl_id))
+            continue
+        molregno = cpd2molregno[molecule_chembl_id]
+        molregnos.extend(molregno if type(molregno) == type(list()) else [molregno])
+
+    written = db_chembl.export_activities(out_file, molregnos, 'molregno', fmt)
+    logger.info("Exported {} activities for {} molecules".format(written, len(molregnos)))
+
 # return the chembl_id for the single protein --
 
 #@smart_cache
@@ -154,10 +177,14 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--file', dest='in_file', help='csv file containing list of gene_symbols', required=True)
     parser.add_argument('-c', '--column', dest='id_column', help='column with chembl id for molecule', required=True)
     parser.add_argument('-o', '--output', dest='out_file', help='optional output file -- otherwise write to stdout')
+    parser.add_argument('-b', '--bulk', dest='bulk', action="store_true", default=False, help='export all activities in one query (all activity columns, no rows for molecules without activities)')
+    parser.add_argument('-F', '--format', dest='out_format', default='csv', choices=['csv', 'parquet'], help='output format for --bulk - csv or parquet (needs pyarrow and an output file)')
     parser.add_argument('-v', '--verbose', dest='verbose', action="store_true", default=False, help='turn on addition information that is sent to stderr')
     parser.add_argument('-d', '--debug', dest='debug', action="store_true", default=False, help='turn on very verbose debug information to stderr')
 
     args = parser.parse_args()
+    if args.bulk and args.out_format == 'parquet' and not args.out_file:
+        parser.error('parquet output (-F parquet) needs an output file (-o)')
     # create logger
     logger = logging.getLogger()
     logger.level = logging.WARN
@@ -171,4 +198,7 @@ if __name__ == "__main__":
     # process the out_file argument
     out_file = args.out_file if args.out_file else ""
 
-    get_molecule_activity_info(args.in_file, args.id_column, out_file)
+    if args.bulk:
+        export_molecule_activities(args.in_file, args.id_column, out_file, args.out_format)
+    else:
+        get_molecule_activity_info(args.in_file, args.id_column, out_file)
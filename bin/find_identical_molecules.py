@@ -5,37 +5,23 @@ Author: Daniel H Robertson
 
 Part of the IBRI cheminformatics system
 
-Specific utilities for working with chembl data
+Match the molecules of a smiles file against a reference smiles file -- only
+the identity keys are computed and each match is a dictionary lookup
 """
 import sys
 import os
 import argparse
 import logging
 import pprint
-from chem_tools import compare_molecules
-
-def read_smiles_file(in_file):
-    """ utility function to read smiles from a file """
-    smiles_list = list()
-    if not os.path.isfile(in_file):
-        logger.critical("Unable to locate defined input file \"" + in_file +"\" for content ... skipping")
-        return None
-    file_ref = open(in_file, "r")
-    for row in file_ref:
-        row = row.rstrip()
-        parts = row.split(' ')
-        smiles_list.append({'name':parts[1], 'smiles':parts[0]})
-    logger.info('read {} smiles from file {}'.format(len(smiles_list), in_file))
-
-    return smiles_list
-
-#TODO: add flag for verbose
-#TODO: add flag to switch between getting results from molecules vs targets
+from chem_utils.objects import Molecules
 
 parser = argparse.ArgumentParser(prog='find_identical_molecules.py',
-    description='create sdf file from list of molecules from chembl.')
+    description='find the molecules of a smiles file that are identical to molecules of a reference smiles file.')
 parser.add_argument('-f', '--file', dest='in_file', help='input smiles to match with the reference smiles')
 parser.add_argument('-r', '--reference', dest='ref_file', help='reference smiles file to match input file smiles')
+parser.add_argument('-k', '--key', dest='key_type', default='smiles', choices=Molecules.identity_key_types,
+    help='identity level - canonical smiles, inchikey, salt stripped fragment or canonical tautomer (default smiles)')
+parser.add_argument('-p', '--processes', dest='processes', type=int, help='number of processes to use for the identity keys')
 parser.add_argument('-v', '--verbose', default=False, action="store_true", help='verbose output')
 
 args = parser.parse_args()
@@ -48,19 +34,22 @@ logger.addHandler(stream_handler)
 if not args.in_file:
     print('stopping. Please us -f to define the smiles file')
     exit()
-smiles = read_smiles_file(args.in_file)
 
 if not args.ref_file:
     print('stopping. Please us -r to define the reference smiles file')
     exit()
-smiles_ref = read_smiles_file(args.ref_file)
 
-for s1 in smiles:
-    matched = 0
-    for s2 in smiles_ref:
-        if compare_molecules.is_identical(s1['smiles'],s2['smiles']):
-            matched = 1
-            print('{}:{}'.format(s1['name'],s2['name']))
-            break
-    if not matched:
-        print('{}:'.format(s1['name']))
+# hash index of the reference identity keys -- first reference name per key
+ref_index = dict()
+ref_records = Molecules.read_smi_records(args.ref_file)
+for ((smiles, name), key) in Molecules.iter_identity_keys(ref_records, args.key_type, args.processes):
+    if key and key not in ref_index:
+        ref_index[key] = name
+
+# stream the input -- molecules that do not parse have no key and no match
+for ((smiles, name), key) in Molecules.iter_identity_keys(Molecules.read_smi_records(args.in_file), args.key_type, args.processes):
+    name = name if name != None else smiles
+    if key and key in ref_index:
+        print('{}:{}'.format(name, ref_index[key]))
+    else:
+        print('{}:'.format(name))
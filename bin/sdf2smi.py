@@ -13,13 +13,18 @@ import logging
 import pprint
 import sys
 import os
+from chem_utils.objects import Converters
 from rdkit import rdBase
 from rdkit import Chem
 
 parser = argparse.ArgumentParser(prog='sdf2smi.py',
     description='convert sdf file to smiles using RDkit.')
-parser.add_argument('-f', '--file', dest='in_file', help='input sdf file')
+parser.add_argument('-f', '--file', dest='in_file', help='input sdf file (.gz/.bz2 compressed ok)', required=True)
 parser.add_argument('-o', '--output', dest='out_file', help='file to write results -- otherwise stdout')
+parser.add_argument('-id', '--idfield', dest='id_field', default='Catalog ID', help='sdf field with the molecule name/id (default "Catalog ID")')
+parser.add_argument('-t', '--threads', dest='threads', type=int, default=1, help='number of threads parsing the sdf (default 1)')
+parser.add_argument('--unordered', default=False, action="store_true", help='with threads - write molecules as they are parsed rather than in file order')
+parser.add_argument('--tmp_dir', dest='tmp_dir', help='directory for decompressing compressed input with threads -- default system temp')
 parser.add_argument('-v', '--verbose', default=False, action="store_true", help='verbose output')
 
 args = parser.parse_args()
@@ -32,26 +37,4 @@ logger.addHandler(stream_handler)
 
 logger.info("RDKit Version: {}".format(rdBase.rdkitVersion))
 
-# process the out_file argument
-out_file = args.out_file if args.out_file else ""
-
-# create the target list
-sdf = Chem.SDMolSupplier(args.in_file)
-name = None
-nskipped = 0
-for mol in sdf:
-    try:
-        name = mol.GetProp('Catalog ID') # need to make this an option
-        name = name.replace(' ', '_')
-        smi = Chem.MolToSmiles(mol)
-        print("{} {}".format(smi, name))
-    except:
-        nskipped += 1
-        logger.error("Issue with structure of {} ... skipping.".format(name))
-
-if nskipped:
-    logger.error("Issue with {} structures that were skipped.".format(nskipped))
-#with open('smiles.smi', 'w') as f:
-#    for mol in sdf:
-#        smi = Chem.MolToSmiles(mol)
-#        f.write("{}\n".format(smi)
+Converters.sdf_to_smi(args.in_file, args.out_file, args.id_field, args.threads, not args.unordered, args.tmp_dir)
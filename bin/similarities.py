@@ -12,16 +12,28 @@ import logging
 import pprint
 import sys
 import os
-from chem_tools import Molecules
+from chem_utils.data import core_utils
+from chem_utils.objects import Molecules
+from chem_utils.objects import Fingerprints
 
 parser = argparse.ArgumentParser(prog='similarities.py',
     description='compute the similarities either intra (one file) or inter (between two files).')
 parser.add_argument('-f1', '--file1', dest='file1', help='file1 - primary file for intra or inter')
 parser.add_argument('-f2', '--file2', dest='file2', help='file2 - the reference file to compute inter similarities with file 1')
 parser.add_argument('-o', '--output', dest='out_file', help='file to write results -- otherwise stdout')
+parser.add_argument('-F', '--format', dest='out_format', default='text', choices=['text', 'csv', 'parquet'],
+    help='output format - text (space separated), csv or parquet (needs pyarrow and an output file)')
+parser.add_argument('-b', '--batch', dest='batch', type=int, default=10000, help='number of results written at a time (default 10000)')
+parser.add_argument('-p', '--processes', dest='processes', type=int, help='number of processes to use for the similarities')
+parser.add_argument('-fp', '--fp_type', dest='fp_type', default=None, choices=Fingerprints.fingerprint_types(),
+    help='fingerprint type -- default {}'.format(Fingerprints.default_fp_type))
 parser.add_argument('-v', '--verbose', default=False, action="store_true", help='verbose output')
 
 args = parser.parse_args()
+if args.out_format == 'parquet' and not args.out_file:
+    parser.error("parquet output needs an output file (-o)")
+if args.out_format == 'parquet' and core_utils.pyarrow == None:
+    parser.error("parquet output needs the pyarrow module")
 
 # create logger
 logger = logging.getLogger()
@@ -33,18 +45,23 @@ logger.addHandler(stream_handler)
 file1 = args.file1 if args.file1 else ""
 file2 = args.file2 if args.file2 else ""
 
-molecules_1 = Molecules.Molecules()
+molecules_1 = Molecules.Molecules(depict=False, fp_type=args.fp_type)
 molecules_1.addFromSmiFile(file1)
 
-sim = list()
 if file2 == "":
-    sim = molecules_1.getIntraSimilarities()
+    sim = molecules_1.iterIntraSimilarities(processes=args.processes)
 else:
-    molecules_2 = Molecules.Molecules()
+    molecules_2 = Molecules.Molecules(depict=False, fp_type=args.fp_type)
     molecules_2.addFromSmiFile(file2)
-    sim = molecules_1.getInterSimilarities(molecules_2)
+    sim = molecules_1.iterInterSimilarities(molecules_2, processes=args.processes)
 
-if len(sim):
-    print("mol1 mol2 similarity")
+# results are written in batches as they are computed
+with core_utils.RowWriter(args.out_file, ['mol1', 'mol2', 'similarity'], ['string', 'string', 'float64'], args.out_format) as writer:
+    batch = list()
     for s in sim:
-        print(s)
+        batch.append(s)
+        if len(batch) >= args.batch:
+            writer.writerows(batch)
+            batch = list()
+    writer.writerows(batch)
+logger.info("Wrote {} similarities".format(writer.rows_written))
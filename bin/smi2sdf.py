@@ -12,15 +12,19 @@ import logging
 import pprint
 import sys
 import os
-from chem_utils.objects import Molecules
+from chem_utils.objects import Converters
 from rdkit import rdBase
 from rdkit import Chem
 
 parser = argparse.ArgumentParser(prog='smi2sdf.py',
     description='convert smi file to sdf using RDkit.')
-parser.add_argument('-f', '--file', dest='in_file', help='input smi file', required=True)
-parser.add_argument('-o', '--output', dest='out_file', help='file to write sdf results -- otherwise stdout', required=True)
+parser.add_argument('-f', '--file', dest='in_file', help='input smi file (.gz/.bz2 compressed ok)', required=True)
+parser.add_argument('-o', '--output', dest='out_file', help='file to write sdf results (.gz/.bz2 compressed by suffix)', required=True)
 parser.add_argument('-id', '--idfield', dest='id_field', help='id field name in sdf to store molecule name/id')
+parser.add_argument('-c', '--chunk', dest='chunk_size', type=int, default=1000, help='number of molecules converted at a time (default 1000)')
+parser.add_argument('-p', '--processes', dest='processes', type=int, help='number of processes to use for the conversion')
+parser.add_argument('--unordered', default=False, action="store_true", help='with processes - write chunks as they finish rather than in input order')
+parser.add_argument('--no_coords', default=False, action="store_true", help='write zero coordinates rather than computing a 2D layout')
 parser.add_argument('-v', '--verbose', default=False, action="store_true", help='verbose output')
 
 args = parser.parse_args()
@@ -35,16 +39,6 @@ logger.info("RDKit Version: {}".format(rdBase.rdkitVersion))
 
 id_field = args.id_field if args.id_field else "ID"
 
-molecules = Molecules.Molecules()
-molecules.addFromSmiFile(args.in_file)
-
-# write out as sdf
-SDWriter = Chem.rdmolfiles.SDWriter(args.out_file)
-SDWriter.SetProps([id_field])
-for i in range(0, molecules.length()):
-    mol = molecules.getMol(i)
-    rd_mol = mol['mol']
-    rd_mol.SetProp(id_field, mol['name'])
-    SDWriter.write(mol['mol'])
-
-logger.info("Wrote {} molecules to {} file".format(molecules.length(), args.out_file))
+# stream the smiles to sdf in chunks
+Converters.smi_to_sdf(args.in_file, args.out_file, id_field, not args.no_coords,
+                      args.chunk_size, args.processes, not args.unordered)
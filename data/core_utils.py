@@ -15,6 +15,13 @@ import logging
 import json
 import csv
 import pprint
+import gzip
+import bz2
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 # create logger
 # TODO -- fix later -- check if logger exists -- and than attach to it
@@ -36,6 +43,23 @@ def file_exists(my_file):
         return False
     return True
 
+# open a text file -- .gz and .bz2 files are decompressed on the fly
+def open_text_file(my_file, mode="r"):
+    """ utility function to open a possibly compressed text file """
+    if str(my_file).endswith('.gz'):
+        return gzip.open(my_file, mode + "t")
+    if str(my_file).endswith('.bz2'):
+        return bz2.open(my_file, mode + "t")
+    return open(my_file, mode)
+
+def open_binary_file(my_file, mode="rb"):
+    """ utility function to open a possibly compressed binary file """
+    if str(my_file).endswith('.gz'):
+        return gzip.open(my_file, mode)
+    if str(my_file).endswith('.bz2'):
+        return bz2.open(my_file, mode)
+    return open(my_file, mode)
+
 # does a file exist
 def remove_file(my_file):
     """ utility function to remove file """
@@ -177,3 +201,74 @@ def write_csv(out_file, item_list, headers):
         csvwriter.writerow(row)
         no_lines += 1
     return no_lines
+
+# size of the write buffer for the row writers
+_write_buffer_ = 1 << 20
+
+class RowWriter:
+    """Streaming writer for rows of typed columns
+
+    fmt "text" writes space separated lines, "csv" a csv file and "parquet" a
+    parquet file (needs pyarrow) -- text and csv go to stdout without an
+    out_file. types are pyarrow type names (string, int64, float64 ...) of
+    the columns, used for parquet. Every writerows call is flushed (one row
+    group for parquet) so readers can start before the writer is closed. The
+    text and csv header goes out with the first rows -- nothing is written
+    without results
+    """
+
+    def __init__(self, out_file, headers, types=None, fmt="csv"):
+        self.headers = list(headers)
+        self.fmt = fmt
+        self.rows_written = 0
+        self._parquet = None
+        self._stream = None
+        if fmt == "parquet":
+            if pyarrow == None:
+                raise ValueError("parquet output needs the pyarrow module")
+            if not out_file:
+                raise ValueError("parquet output needs an output file")
+            types = types if types else ["string"] * len(self.headers)
+            self.schema = pyarrow.schema([(h, pyarrow.type_for_alias(t)) for (h, t) in zip(self.headers, types)])
+            self._parquet = pyarrow.parquet.ParquetWriter(out_file, self.schema)
+            return
+        if fmt != "csv" and fmt != "text":
+            raise ValueError("unknown output format \"{}\" - use text, csv or parquet".format(fmt))
+        self._close_stream = bool(out_file)
+        self._stream = open(out_file, 'w', newline='', buffering=_write_buffer_) if out_file else sys.stdout
+        if fmt == "csv":
+            self._csvwriter = csv.writer(self._stream, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+    # write a batch of rows (sequences in header order)
+    def writerows(self, rows):
+        rows = list(rows)
+        if not len(rows):
+            return
+        if self._parquet != None:
+            columns = [list(column) for column in zip(*rows)]
+            self._parquet.write_table(pyarrow.Table.from_arrays([pyarrow.array(c, type=f.type) for (c, f) in zip(columns, self.schema)], schema=self.schema))
+        elif self.fmt == "csv":
+            if not self.rows_written:
+                self._csvwriter.writerow(self.headers)
+            self._csvwriter.writerows(rows)
+            self._stream.flush()
+        else:
+            if not self.rows_written:
+                self._stream.write(" ".join(self.headers) + "\n")
+            self._stream.writelines(" ".join(str(v) for v in row) + "\n" for row in rows)
+            self._stream.flush()
+        self.rows_written += len(rows)
+
+    def close(self):
+        if self._parquet != None:
+            self._parquet.close()
+        elif self._close_stream:
+            self._stream.close()
+        else:
+            self._stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
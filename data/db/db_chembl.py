@@ -7,15 +7,52 @@ Part of the IBRI cheminformatics system
 
 Specific utilities for working with chembl data directly through the chembl api
 """
+import sys
 import psycopg2
+import psycopg2.pool
 import json
 import logging
+import itertools
+import threading
+import contextlib
+import concurrent.futures
+from .. import core_utils
 
 # Global variables for connections so we don't create multiple
 _postgresql_connector = dict()
 _databases = ['chembl_29', 'chembl_28', 'oprm1_chembl_29']
 _selected_database = _databases[0]
 
+# rows fetched per round trip by the streaming (server side) cursors
+_itersize_ = 10000
+# unique names for the server side cursors
+_cursor_ids_ = itertools.count()
+
+# connections kept open per database by the pool -- also the default number of
+# threads for parallel_queries
+_pool_min_ = 1
+_pool_max_ = 8
+_pool_lock_ = threading.Lock()
+
+# ids sent per query by the id lookups -- larger lists are split
+_id_chunk_ = 100000
+
+# activities selected by each id type in export_activities
+_export_id_columns_ = {
+    'molregno' : 'act.molregno',
+    'assay_id' : 'act.assay_id',
+    'tid'      : 'asy.tid'
+}
+# parquet column types of postgres type oids (everything else is a string)
+_parquet_types_ = {
+    16 : 'bool',
+    20 : 'int64', 21 : 'int64', 23 : 'int64',
+    700 : 'float64', 701 : 'float64', 1700 : 'float64'
+}
+
+# table column names per database (see get_table_columns)
+_schema_cache = dict()
+
 # create logger and set logger level
 logger = logging.getLogger()
 
@@ -33,65 +70,164 @@ def set_database(database):
     _selected_database = database
     return True
 
-# return the rds connector for the database -- only create once per database
-def _get_db_connector():
+# return the connection pool for the database -- only create once per database.
+# Pooled connections are handed to one caller at a time through db_connection
+# and db_cursor so they are safe to use from several threads
+def _get_db_pool(database=None):
     global _postgresql_connector
-    global _selected_database
-
-    if _selected_database not in _postgresql_connector:
-        _postgresql_connector[_selected_database] = dict()
-
-    if 'conn' not in _postgresql_connector[_selected_database] or _postgresql_connector[_selected_database]['conn'] == None:
-        # go ahead and try to connect
+    database = database if database else _selected_database
+
+    with _pool_lock_:
+        if database not in _postgresql_connector:
+            _postgresql_connector[database] = dict()
+
+        if 'pool' not in _postgresql_connector[database] or _postgresql_connector[database]['pool'] == None:
+            try:
+                _postgresql_connector[database]['pool'] = psycopg2.pool.ThreadedConnectionPool(_pool_min_, _pool_max_, dbname=database)
+                # ThreadedConnectionPool raises when empty -- callers wait for a slot instead
+                _postgresql_connector[database]['slots'] = threading.BoundedSemaphore(_pool_max_)
+            except Exception as e:
+                logger.error('***DB Connection Pool Create Error for {}: {}'.format(database, e))
+                _postgresql_connector[database]['pool'] = None
+
+    return _postgresql_connector[database]['pool']
+
+# borrow a connection from the pool of the database (waits while all are in use)
+# -- None if the pool could not be created
+@contextlib.contextmanager
+def db_connection(database=None):
+    database = database if database else _selected_database
+    pool = _get_db_pool(database)
+    if pool == None:
+        yield None
+        return
+    slots = _postgresql_connector[database]['slots']
+    slots.acquire()
+    try:
+        conn = pool.getconn()
         try:
-            _postgresql_connector[_selected_database]['conn'] = psycopg2.connect(dbname=_selected_database)
-        except Exception as e:
-            logger.error('***DB Connection Create Error for {}: {}'.format(_selected_database, e))
-            _postgresql_connector[_selected_database]['conn'] = None
-
-    return _postgresql_connector[_selected_database]['conn']
-
-# return the rds connector for the database -- only create once per database
-def _get_db_cursor():
-    global _postgresql_connector
-    global _selected_database
-
-    if _selected_database not in _postgresql_connector:
-        _postgresql_connector[_selected_database] = dict()
-
-    if 'cur' not in _postgresql_connector[_selected_database] or _postgresql_connector[_selected_database]['cur'] == None:
-        # go ahead and try to connect
+            yield conn
+        finally:
+            # the pool rolls back anything left open
+            pool.putconn(conn)
+    finally:
+        slots.release()
+
+# cursor on a pooled connection for the duration of the with block -- safe to
+# use from several threads at once. Yields None if no connection could be made
+@contextlib.contextmanager
+def db_cursor(database=None):
+    with db_connection(database) as conn:
+        if conn == None:
+            yield None
+            return
+        cur = conn.cursor()
         try:
-            conn = _get_db_connector()
-            _postgresql_connector[_selected_database]['cur'] = conn.cursor()
-        except Exception as e:
-            logger.error('***DB Connection Cursor Error: {}'.format(e))
-            _postgresql_connector[_selected_database]['cur'] = None
-
-    return _postgresql_connector[_selected_database]['cur']
-
-def _db_execute(sql_statement):
-    cur = _get_db_cursor()
+            yield cur
+        finally:
+            cur.close()
+
+# close all pooled connections of all databases
+def close_db_pools():
+    with _pool_lock_:
+        for database in _postgresql_connector:
+            if _postgresql_connector[database].get('pool') != None:
+                _postgresql_connector[database]['pool'].closeall()
+                _postgresql_connector[database]['pool'] = None
+
+# run sql_statement (with %s placeholders bound to params) and return all rows
+# -- if fields is a list it is filled with the column names of the result
+def _db_execute(sql_statement, fields=None, params=None):
     data = None
-    try:
-        cur.execute(sql_statement)
-        data = cur.fetchall()
-    except Exception as e:
-        logger.error('***DB Execute Error: {}'.format(e))
-        conn = _get_db_connector()
-        conn.rollback()
+    with db_cursor() as cur:
+        if cur == None:
+            return None
+        try:
+            cur.execute(sql_statement, params)
+            data = cur.fetchall()
+            if fields != None and cur.description:
+                fields.extend([column[0] for column in cur.description])
+        except Exception as e:
+            logger.error('***DB Execute Error: {}'.format(e))
+            cur.connection.rollback()
     # post process the data
     return data
 
+# stream the results of sql_statement through a named (server side) cursor --
+# yields lists of up to batch_size rows so only one batch is held in memory at
+# a time. If fields is a list it is filled with the column names. A database
+# error is logged and raised again after the rollback so a failure part way
+# through the results is not mistaken for the end of them
+def _db_execute_iter(sql_statement, batch_size=_itersize_, fields=None, params=None, types=None):
+    # the pooled connection is held until the results are exhausted or the
+    # generator is closed
+    with db_connection() as conn:
+        if conn == None:
+            return
+        cur = None
+        try:
+            cur = conn.cursor(name="chem_utils_stream_{}".format(next(_cursor_ids_)))
+            cur.itersize = batch_size
+            cur.execute(sql_statement, params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if fields != None and not len(fields) and cur.description:
+                    fields.extend([column[0] for column in cur.description])
+                if types != None and not len(types) and cur.description:
+                    types.extend([column[1] for column in cur.description])
+                if not rows:
+                    break
+                yield rows
+        except Exception as e:
+            logger.error('***DB Execute Error: {}'.format(e))
+            conn.rollback()
+            # the rollback dropped the server side cursor
+            cur = None
+            raise
+        finally:
+            # also when the caller stopped early -- release the server side cursor
+            if cur != None and not cur.closed:
+                cur.close()
+
+# stream the results of sql_statement as lists of up to batch_size dicts
+# (column name : value) -- raises on a database error as _db_execute_iter
+def _db_execute_json_iter(sql_statement, batch_size=_itersize_, params=None):
+    fields = list()
+    for rows in _db_execute_iter(sql_statement, batch_size, fields, params):
+        yield [dict(zip(fields, row)) for row in rows]
+
+# run function (one of the lookups below) on every item of items on threads
+# threads -- each call gets its own pooled connection so the queries run
+# concurrently. Returns the results in the order of items, None for a call
+# that raised
+def parallel_queries(function, items, threads=_pool_max_):
+    items = list(items)
+    threads = max(1, min(threads if threads else _pool_max_, _pool_max_))
+    results = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(function, item) for item in items]
+        for (item, future) in zip(items, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error('***DB Parallel Query Error for {}: {}'.format(item, e))
+                results.append(None)
+    return results
+
 # utility functions
-def _ids_to_str_list(ids):
+
+# the ids as postgres array literals of at most chunk_size ids each -- bound to
+# "column = ANY(%s)" the literal takes the type of the column, so string and
+# integer ids both work as they did in the IN lists
+def _ids_to_arrays(ids, chunk_size=None):
+    chunk_size = chunk_size if chunk_size else _id_chunk_
     ids_list = ids
     if type(ids_list) != type(list()):
         ids_list = [ids]
 
-    ids_list_str = ','.join(f"'{id}'" for id in ids_list)
-
-    return ids_list_str
+    for start in range(0, len(ids_list), chunk_size):
+        chunk = ids_list[start:start + chunk_size]
+        yield '{' + ','.join('"{}"'.format(str(id).replace('\\', '\\\\').replace('"', '\\"')) for id in chunk) + '}'
 
 def _structured_to_json(data):
     results_json = list()
@@ -111,24 +247,21 @@ def _structured_to_json(data):
     logger.debug("results_json: {}".format(results_json))
     return results_json
 
-def _db_execute_structured(sql_statement, table, limit=None):
+def _db_execute_structured(sql_statement, table, limit=None, params=None):
 
     data = {
         'fields' : list(),
         'values' : list()
     }
 
-    # get columns from table and add to data object
-    sql = "SELECT column_name FROM information_schema.columns WHERE TABLE_NAME='{}'".format(table)
-    db_results = _db_execute(sql)
-    for result in db_results:
-        data['fields'].append(result[0])
-
-    # do data query and put values in place
+    # do data query and put values in place -- the fields are the columns of
+    # the result (table columns only if the query failed)
     sql = sql_statement
     if limit:
         sql = "{} limit {}".format(sql, limit)
-    sql_results = _db_execute(sql)
+    sql_results = _db_execute(sql, data['fields'], params)
+    if not len(data['fields']):
+        data['fields'] = list(get_table_columns(table))
     if sql_results:
         for row in sql_results:
             new_row = list()
@@ -138,11 +271,63 @@ def _db_execute_structured(sql_statement, table, limit=None):
 
     return data
 
+# _db_execute_structured of "sql_statement = ANY(ids)" -- one query per chunk
+# of ids. None if any of the queries failed
+def _db_execute_structured_ids(sql_statement, ids, table):
+    data = {
+        'fields' : list(),
+        'values' : list()
+    }
+    for ids_array in _ids_to_arrays(ids):
+        fields = list()
+        sql_results = _db_execute("{} = ANY(%s)".format(sql_statement), fields, (ids_array,))
+        if sql_results == None:
+            return None
+        data['fields'] = fields
+        data['values'].extend([list(row) for row in sql_results])
+    if not len(data['fields']):
+        data['fields'] = list(get_table_columns(table))
+    return data
+
+# column names of table in column order -- cached per database until
+# invalidate_schema_cache
+def get_table_columns(table, database=None):
+    database = database if database else _selected_database
+    with _pool_lock_:
+        if table in _schema_cache.get(database, dict()):
+            return _schema_cache[database][table]
+    sql = "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position"
+    columns = list()
+    with db_cursor(database) as cur:
+        if cur == None:
+            return columns
+        try:
+            cur.execute(sql, (table,))
+            columns = [result[0] for result in cur.fetchall()]
+        except Exception as e:
+            logger.error('***DB Execute Error: {}'.format(e))
+            cur.connection.rollback()
+            return columns
+    with _pool_lock_:
+        _schema_cache.setdefault(database, dict())[table] = columns
+    return columns
+
+# forget the cached columns of database (all databases if not given) -- call
+# after the schema changes
+def invalidate_schema_cache(database=None):
+    with _pool_lock_:
+        if database == None:
+            _schema_cache.clear()
+        else:
+            _schema_cache.pop(database, None)
+
 ###############################################################################
 ## individual methods                                                        ##
 ## TODO: refactor to have wrapper functions depending on whether api or db   ##
 ###############################################################################
 
+# the lookups return None if a query failed -- an empty result is no matches
+
 def get_all_tids():
     """ get all tids from target_dictionary"""
     sql_results = _db_execute('select tid from target_dictionary')
@@ -189,6 +374,8 @@ def assay_ids_from_tids(tids):
     """ search for assay_id by tid in assays"""
     results = _get_id_mapping(tids, 'select tid,assay_id from assays where tid')
     logger.debug("results: {}".format(results))
+    if results == None:
+        return None
 
     # handle return value type (remove from dict if single value)
     logger.debug("type: {} len: {}".format(type(tids), len(results)))
@@ -202,9 +389,9 @@ def chembl_ids_from_assay_ids(assay_ids):
 
 def assay_details_from_assay_ids(assay_ids):
     """ get assay details assay_id from assays"""
-    ids_list_str = _ids_to_str_list(assay_ids)
-    sql_statement = "{} in ({})".format('select * from assays where assay_id', ids_list_str)
-    sql_results = _db_execute_structured(sql_statement, 'assays')
+    sql_results = _db_execute_structured_ids('select * from assays where assay_id', assay_ids, 'assays')
+    if sql_results == None:
+        return None
     logger.debug("results: {}".format(sql_results))
     json_results = _structured_to_json(sql_results)
 
@@ -228,9 +415,9 @@ def get_all_assay_ids():
 
 def activities_from_assay_ids(assay_ids):
     """ retrieve all activities for assay_ids from activities"""
-    ids_list_str = _ids_to_str_list(assay_ids)
-    sql_statement = "{} in ({})".format('select * from activities where assay_id', ids_list_str)
-    sql_results = _db_execute_structured(sql_statement, 'activities')
+    sql_results = _db_execute_structured_ids('select * from activities where assay_id', assay_ids, 'activities')
+    if sql_results == None:
+        return None
     #logger.debug("results: {}".format(sql_results))
     json_results = _structured_to_json(sql_results)
 
@@ -239,15 +426,148 @@ def activities_from_assay_ids(assay_ids):
 
 def activities_from_molregnos(molregnos):
     """ retrieve all activities for assay_ids from activities"""
-    ids_list_str = _ids_to_str_list(molregnos)
-    sql_statement = "{} in ({})".format('select * from activities where molregno', ids_list_str)
-    sql_results = _db_execute_structured(sql_statement, 'activities')
+    sql_results = _db_execute_structured_ids('select * from activities where molregno', molregnos, 'activities')
+    if sql_results == None:
+        return None
     #logger.debug("results: {}".format(sql_results))
     json_results = _structured_to_json(sql_results)
 
     #logger.debug("json results: {}".format(json_results))
     return json_results
 
+def iter_activities_from_assay_ids(assay_ids, batch_size=_itersize_, batches=False):
+    """ stream all activities for assay_ids from activities -- one dict per
+        activity or lists of up to batch_size dicts with batches. A database
+        error part way through is raised (psycopg2.Error) """
+    return _iter_json_rows('select * from activities where assay_id', assay_ids, batch_size, batches)
+
+def iter_activities_from_molregnos(molregnos, batch_size=_itersize_, batches=False):
+    """ stream all activities for molregnos from activities -- one dict per
+        activity or lists of up to batch_size dicts with batches. A database
+        error part way through is raised (psycopg2.Error) """
+    return _iter_json_rows('select * from activities where molregno', molregnos, batch_size, batches)
+
+# rows or batches of rows of "sql_statement = ANY(ids)" streamed as dicts
+def _iter_json_rows(sql_statement, ids, batch_size, batches):
+    json_batches = _iter_json_batches(sql_statement, ids, batch_size)
+    if batches:
+        return json_batches
+    return _iter_rows(json_batches)
+
+# batches of every chunk of ids in turn
+def _iter_json_batches(sql_statement, ids, batch_size):
+    for ids_array in _ids_to_arrays(ids):
+        yield from _db_execute_json_iter("{} = ANY(%s)".format(sql_statement), batch_size, (ids_array,))
+
+# flatten batches -- a generator so closing it early closes the cursor
+def _iter_rows(json_batches):
+    try:
+        for batch in json_batches:
+            yield from batch
+    finally:
+        json_batches.close()
+
+def export_activities(out_file, ids, id_type='molregno', fmt='csv'):
+    """ export all activities for ids (molregnos, assay_ids or tids by
+        id_type) with the molecule_chembl_id to a csv (through COPY, .gz/.bz2
+        compressed by suffix, stdout without out_file) or parquet file --
+        one query per chunk of ids. Returns the number of activities written """
+    if type(ids) == type(list()) and not len(ids):
+        logger.warning("No ids given to export activities for")
+        return 0
+    if id_type not in _export_id_columns_:
+        logger.error("Unable to export activities by \"{}\" -- use one of {}".format(id_type, list(_export_id_columns_.keys())))
+        return None
+    sql_statement = "select md.chembl_id as molecule_chembl_id, act.* from activities act join molecule_dictionary md on md.molregno = act.molregno"
+    if id_type == 'tid':
+        sql_statement = "{} join assays asy on asy.assay_id = act.assay_id".format(sql_statement)
+    sql_statement = "{} where {} = ANY(%s)".format(sql_statement, _export_id_columns_[id_type])
+    if fmt == 'csv':
+        return _export_csv(out_file, sql_statement, ids)
+    if fmt == 'parquet':
+        return _export_parquet(out_file, sql_statement, ids)
+    logger.error("Unknown export format \"{}\" - use csv or parquet".format(fmt))
+    return None
+
+# COPY the results of "sql_statement" (one ANY(%s) placeholder) for every chunk
+# of ids straight into a csv file -- header from the first chunk only
+def _export_csv(out_file, sql_statement, ids):
+    written = 0
+    with db_cursor() as cur:
+        if cur == None:
+            return None
+        # the file is only opened once there is a connection
+        file_ref = core_utils.open_text_file(out_file, "w") if out_file else sys.stdout
+        try:
+            header = "HEADER"
+            for ids_array in _ids_to_arrays(ids):
+                select = cur.mogrify(sql_statement, (ids_array,)).decode()
+                cur.copy_expert("COPY ({}) TO STDOUT WITH CSV {}".format(select, header), file_ref)
+                written += cur.rowcount
+                header = ""
+        except Exception as e:
+            logger.error('***DB Copy Error: {}'.format(e))
+            cur.connection.rollback()
+            written = None
+        finally:
+            if out_file:
+                file_ref.close()
+    if written == None:
+        # no partial exports
+        if out_file and core_utils.file_exists(out_file):
+            core_utils.remove_file(out_file)
+        return None
+    logger.info("Exported {} activities to \"{}\"".format(written, out_file if out_file else "stdout"))
+    return written
+
+# stream the results of "sql_statement" for every chunk of ids into a parquet
+# file -- the column types come from the query. A failed chunk removes the
+# file rather than leave a partial export
+def _export_parquet(out_file, sql_statement, ids):
+    fields = list()
+    types = list()
+    writer = None
+    written = None
+    try:
+        for ids_array in _ids_to_arrays(ids):
+            for rows in _db_execute_iter(sql_statement, _itersize_, fields, (ids_array,), types):
+                if writer == None:
+                    writer = _parquet_writer(out_file, fields, types)
+                writer.writerows(_parquet_rows(rows, writer.schema))
+        if writer == None and len(fields):
+            writer = _parquet_writer(out_file, fields, types)
+        if writer != None:
+            written = writer.rows_written
+    except Exception as e:
+        logger.error('***DB Export Error: {}'.format(e))
+    finally:
+        if writer != None:
+            writer.close()
+    if written == None:
+        logger.error("Unable to export activities to \"{}\"".format(out_file))
+        # no partial exports
+        if core_utils.file_exists(out_file):
+            core_utils.remove_file(out_file)
+        return None
+    logger.info("Exported {} activities to \"{}\"".format(written, out_file))
+    return written
+
+def _parquet_writer(out_file, fields, types):
+    return core_utils.RowWriter(out_file, fields, [_parquet_types_.get(code, 'string') for code in types], "parquet")
+
+# convert rows to the column types of the parquet schema (numeric to float,
+# dates and others to strings)
+def _parquet_rows(rows, schema):
+    converters = list()
+    for field in schema:
+        if str(field.type) == 'double':
+            converters.append(float)
+        elif str(field.type) == 'string':
+            converters.append(str)
+        else:
+            converters.append(None)
+    return [[value if value == None or convert == None else convert(value) for (value, convert) in zip(row, converters)] for row in rows]
+
 def get_bioactivities_for_targets(chembl_ids):
     """ retrieve all activities for target chembl_ids from activities"""
 
@@ -263,11 +583,16 @@ def get_bioactivities_for_targets(chembl_ids):
 
 
 # generalized function assuming two values returned generate a dictionary that has one in front of the other
+# -- the ids are bound as arrays, one query per chunk of ids. None if any of
+# the queries failed (rather than an empty dictionary for no matches)
 def _get_id_mapping(ids, sql_statement):
-    ids_list_str = _ids_to_str_list(ids)
-    sql_statement = "{} in ({})".format(sql_statement, ids_list_str)
-    sql_results = _db_execute(sql_statement)
-    logger.debug("sql results: {}".format(sql_results))
+    sql_results = list()
+    for ids_array in _ids_to_arrays(ids):
+        chunk_results = _db_execute("{} = ANY(%s)".format(sql_statement), params=(ids_array,))
+        if chunk_results == None:
+            return None
+        sql_results.extend(chunk_results)
+    logger.debug("sql results: {}".format(len(sql_results)))
     results = dict()
     if sql_results:
         for result in sql_results:
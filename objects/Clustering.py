@@ -0,0 +1,145 @@
+"""
+Clustering.py
+------------
+Author: Daniel H Robertson
+
+Part of the IBRI cheminformatics system
+
+Clustering and diversity picking of packed fingerprints (see Fingerprints) --
+Butina clustering from neighbour lists streamed out of similarity tiles,
+leader (sphere exclusion) clustering for sets too large for the neighbour
+lists and MaxMin picking. Distances are 1 - tanimoto as in rdkit Butina.
+
+Everything runs in the calling process -- there is no process pool. The only
+parallelism is whatever threads the numpy BLAS uses for the similarity tile
+matrix products, so the neighbour lists of a large set are bound to one core
+on a single threaded BLAS.
+"""
+import logging
+import numpy as np
+from chem_utils.objects import Fingerprints
+logger = logging.getLogger()
+
+# rows (and columns) of the similarity tiles computed at a time
+_tile_rows_ = 4096
+
+# neighbour lists of every fingerprint -- all pairs within distance threshold.
+# The upper triangle is computed tile by tile and only the neighbour pairs are
+# kept. Returns (indptr, indices) with the neighbours of i (not including i)
+# in indices[indptr[i]:indptr[i+1]] in increasing order. The tiles are
+# computed one after another in this process (see the module docstring)
+def neighbour_lists(fps, threshold, tile=_tile_rows_):
+    n = len(fps)
+    rows = list()
+    cols = list()
+    for a_start in range(0, n, tile):
+        a_fps = fps.take(slice(a_start, a_start + tile))
+        for b_start in range(a_start, n, tile):
+            b_fps = a_fps if b_start == a_start else fps.take(slice(b_start, b_start + tile))
+            close = 1.0 - Fingerprints.tanimoto_many_to_many(a_fps, b_fps) <= threshold
+            if b_start == a_start:
+                close = np.triu(close, 1)
+            (i, j) = np.nonzero(close)
+            rows.append((i + a_start).astype(np.int32))
+            cols.append((j + b_start).astype(np.int32))
+    i = np.concatenate(rows + cols) if n else np.zeros(0, dtype=np.int32)
+    j = np.concatenate(cols + rows) if n else np.zeros(0, dtype=np.int32)
+    order = np.lexsort((j, i))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(i, minlength=n), out=indptr[1:])
+    logger.debug("Clustering.neighbour_lists: len: {} neighbour pairs: {}".format(n, len(i) // 2))
+    return (indptr, j[order])
+
+# Butina clustering -- the fingerprint with the most unassigned neighbours
+# becomes a centroid and takes all of them (ties to the higher index as rdkit
+# Butina.ClusterData without reordering). Returns (cluster_ids, centroids) --
+# the cluster of every fingerprint and the fingerprint index of every cluster
+# centroid, clusters in the order they were formed
+def butina_clusters(fps, threshold):
+    n = len(fps)
+    (indptr, indices) = neighbour_lists(fps, threshold)
+    counts = np.diff(indptr)
+    cluster_ids = np.full(n, -1, dtype=np.int64)
+    centroids = list()
+    for i in np.lexsort((-np.arange(n), -counts)):
+        if cluster_ids[i] >= 0:
+            continue
+        nbrs = indices[indptr[i]:indptr[i + 1]]
+        cluster_ids[nbrs[cluster_ids[nbrs] < 0]] = len(centroids)
+        cluster_ids[i] = len(centroids)
+        centroids.append(int(i))
+    logger.debug("Clustering.butina_clusters: len: {} clusters: {}".format(n, len(centroids)))
+    return (cluster_ids, centroids)
+
+# leader (sphere exclusion) clustering in fingerprint order -- a fingerprint
+# within threshold of an earlier centroid joins the most similar one (ties to
+# the earlier centroid), otherwise it becomes a new centroid. Fingerprints are
+# compared against the centroids in blocks so memory is O(block * centroids).
+# Returns (cluster_ids, centroids) as butina_clusters
+def leader_clusters(fps, threshold, block=_tile_rows_):
+    n = len(fps)
+    cluster_ids = np.full(n, -1, dtype=np.int64)
+    centroids = list()
+    for start in range(0, n, block):
+        block_fps = fps.take(slice(start, start + block))
+        m = len(block_fps)
+        best = np.zeros(m, dtype=np.int64)
+        best_sim = np.full(m, -1.0)
+        if len(centroids):
+            sims = Fingerprints.tanimoto_many_to_many(block_fps, fps.take(np.array(centroids)))
+            best = sims.argmax(axis=1)
+            best_sim = sims[np.arange(m), best]
+        # rows not near an earlier centroid in order -- a new centroid can take
+        # the rows after it in the block
+        for r in np.nonzero(1.0 - best_sim > threshold)[0]:
+            if 1.0 - best_sim[r] <= threshold:
+                continue
+            (best[r], best_sim[r]) = (len(centroids), 1.0)
+            centroids.append(start + int(r))
+            if r + 1 < m:
+                sims = Fingerprints.tanimoto_one_to_many(block_fps, int(r), block_fps.take(slice(r + 1, m)))
+                better = np.nonzero(sims > best_sim[r + 1:])[0] + r + 1
+                best[better] = best[r]
+                best_sim[better] = sims[better - r - 1]
+        cluster_ids[start:start + m] = best
+    logger.debug("Clustering.leader_clusters: len: {} clusters: {}".format(n, len(centroids)))
+    return (cluster_ids, centroids)
+
+# distance from every fingerprint of fps to its nearest fingerprint in
+# seed_fps -- compared in block x block tiles so memory stays O(N + block^2)
+def _nearest_distances(fps, seed_fps, block=_tile_rows_):
+    min_dist = np.full(len(fps), np.inf)
+    for start in range(0, len(seed_fps), block):
+        block_seeds = seed_fps.take(slice(start, start + block))
+        for col in range(0, len(fps), block):
+            sims = Fingerprints.tanimoto_many_to_many(block_seeds, fps.take(slice(col, col + block)))
+            np.minimum(min_dist[col:col + block], 1.0 - sims.max(axis=0), out=min_dist[col:col + block])
+    return min_dist
+
+# MaxMin diversity picking -- repeatedly picks the fingerprint furthest from
+# its nearest pick (ties to the lower index). Only the running distance to the
+# nearest pick is kept so memory is O(N). seeds (indices into fps) and
+# seed_fps (fingerprints of an existing selection) count as picks made
+# beforehand -- without either the first pick is first_pick. Returns the new
+# picks in pick order
+def maxmin_pick(fps, n_picks, seeds=None, seed_fps=None, first_pick=0):
+    n = len(fps)
+    min_dist = np.full(n, np.inf)
+    if seed_fps is not None and len(seed_fps):
+        min_dist = _nearest_distances(fps, seed_fps)
+    if seeds is not None and len(seeds):
+        seeds = np.asarray(seeds, dtype=np.int64)
+        np.minimum(min_dist, _nearest_distances(fps, fps.take(seeds)), out=min_dist)
+        min_dist[seeds] = -1.0
+    available = int((min_dist >= 0).sum())
+    if n_picks > available:
+        logger.warning("Clustering.maxmin_pick: only {} fingerprints available for {} picks".format(available, n_picks))
+        n_picks = available
+    picks = list()
+    while len(picks) < n_picks:
+        pick = first_pick if np.isinf(min_dist).all() else int(min_dist.argmax())
+        picks.append(pick)
+        np.minimum(min_dist, 1.0 - Fingerprints.tanimoto_one_to_many(fps, pick, fps), out=min_dist)
+        min_dist[pick] = -1.0
+    logger.debug("Clustering.maxmin_pick: len: {} picks: {}".format(n, len(picks)))
+    return picks
@@ -0,0 +1,116 @@
+"""
+Converters.py
+------------
+Author: Daniel H Robertson
+
+Part of the IBRI cheminformatics system
+
+Streaming file format conversions (smiles to sdf, sdf to smiles) -- records
+are read, converted and written as they go so memory does not grow with the
+file, without building a Molecules set (no fingerprints or depictions)
+"""
+import sys
+import logging
+import functools
+from rdkit import Chem
+from rdkit.Chem import rdDepictor
+from chem_utils.data import core_utils
+from chem_utils.objects import Molecules
+logger = logging.getLogger()
+
+# name the unnamed records of a stream of record chunks as Molecules does
+def _name_records(chunks):
+    count = 0
+    for chunk in chunks:
+        named = list()
+        for (smiles, name) in chunk:
+            if name == None:
+                name = "mol_name_{:05d}".format(count)
+                count += 1
+            named.append((smiles, name))
+        yield named
+
+# convert a chunk of (smiles, name) records to mol blocks -- returns
+# ([(mol block, name), ...], [(smiles, name, reason), ...] of the failures).
+# The data fields are written by _sdf_record in the parent so the record
+# numbers run on across chunks. coords=False writes zero 2D coordinates
+# instead of computing a layout
+def _sdf_chunk(records, coords=True):
+    blocks = list()
+    errors = list()
+    for (smiles, name) in records:
+        try:
+            (c_smiles, rd_mol) = Molecules._canonical_mol(smiles)
+        except Exception as e:
+            errors.append((smiles, name, str(e)))
+            continue
+        if coords:
+            rdDepictor.Compute2DCoords(rd_mol)
+        else:
+            conformer = Chem.Conformer(rd_mol.GetNumAtoms())
+            conformer.Set3D(False)
+            rd_mol.AddConformer(conformer)
+        blocks.append((Chem.MolToMolBlock(rd_mol), name))
+    return (blocks, errors)
+
+# sd record of a mol block with the name in the id_field data field -- as
+# Chem.SDWriter writes it, number is the (1 based) record number in the file
+def _sdf_record(block, id_field, name, number):
+    return "{}>  <{}>  ({}) \n{}\n\n$$$$\n".format(block, id_field, number, name)
+
+# write the molecules of an sd file (plain, .gz or .bz2) as "smiles name"
+# lines to out_file (stdout if not given) -- the name is the id_field property
+# and molecules that fail to parse or have no name are skipped. See
+# Molecules.read_sdf_records for threads and ordered. Returns (number written, number
+# skipped)
+def sdf_to_smi(in_file, out_file=None, id_field=None, threads=1, ordered=True, tmp_dir=None):
+    if not core_utils.file_exists(in_file):
+        logger.error("Unable to locate file \"{}\" .. skipping".format(in_file))
+        return None
+    written = 0
+    skipped = 0
+    file_ref = core_utils.open_text_file(out_file, "w") if out_file else sys.stdout
+    try:
+        for (record, rd_mol) in Molecules.read_sdf_records(in_file, threads, ordered, tmp_dir):
+            name = Molecules.sdf_mol_name(rd_mol, id_field) if rd_mol != None else None
+            if name == None:
+                skipped += 1
+                logger.error("Issue with structure of record {} ... skipping.".format(record))
+                continue
+            file_ref.write("{} {}\n".format(Chem.MolToSmiles(rd_mol), name))
+            written += 1
+    finally:
+        if out_file:
+            file_ref.close()
+    if skipped:
+        logger.error("Issue with {} structures that were skipped.".format(skipped))
+    logger.info("Wrote {} molecules from \"{}\"".format(written, in_file))
+    return (written, skipped)
+
+# convert a smiles file (plain, .gz or .bz2) to an sdf file (.gz/.bz2
+# compressed by suffix) in chunks of chunk_size -- with processes > 1 the
+# chunks are converted on a process pool, written in input order unless
+# ordered is False. The molecule name goes into the id_field property.
+# Returns (number written, number skipped)
+def smi_to_sdf(in_file, out_file, id_field="ID", coords=True, chunk_size=1000, processes=None, ordered=True):
+    if not core_utils.file_exists(in_file):
+        logger.error("Unable to locate file \"{}\" .. skipping".format(in_file))
+        return None
+    chunks = _name_records(Molecules.read_smi_chunks(in_file, chunk_size))
+    convert = functools.partial(_sdf_chunk, coords=coords)
+    if processes and processes > 1:
+        results = Molecules._bounded_map(convert, chunks, processes, ordered)
+    else:
+        results = map(convert, chunks)
+    written = 0
+    skipped = 0
+    with core_utils.open_text_file(out_file, "w") as file_ref:
+        for (blocks, errors) in results:
+            for (block, name) in blocks:
+                written += 1
+                file_ref.write(_sdf_record(block, id_field, name, written))
+            skipped += len(errors)
+            for (smiles, name, reason) in errors:
+                logger.error("Issue converting ({}, {}) for reason \"{}\"..skipping".format(smiles, name, reason))
+    logger.info("Wrote {} molecules from \"{}\" to \"{}\"".format(written, in_file, out_file))
+    return (written, skipped)
@@ -0,0 +1,427 @@
+"""
+Fingerprints.py
+------------
+Author: Daniel H Robertson
+
+Part of the IBRI cheminformatics system
+
+Registry of the fingerprint types, packed (numpy) storage of RDKit bit vector
+fingerprints and the vectorized Tanimoto kernels used by the Molecules
+similarity methods
+"""
+import time
+import logging
+import multiprocessing
+import numpy as np
+from rdkit import Chem
+from rdkit import DataStructs
+from rdkit.Chem import MACCSkeys
+from rdkit.Chem import rdFingerprintGenerator
+from rdkit.Chem.Fingerprints import FingerprintMols
+logger = logging.getLogger()
+
+_word_bits_ = 64
+# limit on the (rows x cols x words) intermediate used when comparing blocks
+_block_words_ = 1 << 22
+
+# number of set bits per uint64 word -- numpy >= 2.0 has this built in
+if hasattr(np, 'bitwise_count'):
+    def _popcount(words):
+        return np.bitwise_count(words)
+else:
+    _byte_counts_ = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    def _popcount(words):
+        words = np.ascontiguousarray(words)
+        counts = _byte_counts_[words.view(np.uint8)]
+        return counts.reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+# rdkit topological fingerprint folded to a target density -- the original
+# Molecules fingerprint
+def _rdkit_fingerprints(mols, num_threads=1):
+    return [FingerprintMols.FingerprintMol(rd_mol) for rd_mol in mols]
+
+def _maccs_fingerprints(mols, num_threads=1):
+    return [MACCSkeys.GenMACCSKeys(rd_mol) for rd_mol in mols]
+
+# substructure screening fingerprint -- the bits of a substructure (or SMARTS
+# query mol) are a subset of the bits of any molecule containing it
+def _pattern_fingerprints(mols, num_threads=1):
+    return [Chem.PatternFingerprint(rd_mol, fpSize=2048) for rd_mol in mols]
+
+# batch fingerprints from an rdkit fingerprint generator -- the generators are
+# created once per process on first use
+_generators_ = dict()
+def _generator_fingerprints(name, create):
+    def fingerprints(mols, num_threads=1):
+        if name not in _generators_:
+            _generators_[name] = create()
+        generator = _generators_[name]
+        if hasattr(generator, 'GetFingerprints'):
+            return list(generator.GetFingerprints(mols, numThreads=num_threads))
+        return [generator.GetFingerprint(rd_mol) for rd_mol in mols]
+    return fingerprints
+
+# registry of fingerprint types -- fp_type : number of bits and the function
+# computing the fingerprints of a list of mols
+_fingerprint_types_ = {
+    'rdkit' : {
+        'nbits' : 2048,
+        'function' : _rdkit_fingerprints
+    },
+    'morgan' : {
+        'nbits' : 1024,
+        'function' : _generator_fingerprints('morgan', lambda: rdFingerprintGenerator.GetMorganGenerator(radius=2, fpSize=1024))
+    },
+    'atompair' : {
+        'nbits' : 2048,
+        'function' : _generator_fingerprints('atompair', lambda: rdFingerprintGenerator.GetAtomPairGenerator(fpSize=2048))
+    },
+    'maccs' : {
+        'nbits' : 167,
+        'function' : _maccs_fingerprints
+    },
+    'pattern' : {
+        'nbits' : 2048,
+        'function' : _pattern_fingerprints
+    }
+}
+default_fp_type = 'rdkit'
+
+# add a fingerprint type -- function(mols, num_threads) returns a list of
+# ExplicitBitVects of at most nbits
+def register_fingerprint(fp_type, nbits, function):
+    _fingerprint_types_[fp_type] = {
+        'nbits' : nbits,
+        'function' : function
+    }
+
+def fingerprint_types():
+    return list(_fingerprint_types_.keys())
+
+def _fingerprint_type(fp_type):
+    fp_type = fp_type if fp_type else default_fp_type
+    if fp_type not in _fingerprint_types_:
+        raise ValueError("unknown fingerprint type \"{}\" - valid types are {}".format(fp_type, fingerprint_types()))
+    return _fingerprint_types_[fp_type]
+
+# number of bits of a fingerprint type
+def fingerprint_bits(fp_type=None):
+    return _fingerprint_type(fp_type)['nbits']
+
+# fingerprints of a list of rdkit mols in one batch
+def fingerprint_mols(mols, fp_type=None, num_threads=1):
+    return _fingerprint_type(fp_type)['function'](mols, num_threads)
+
+# fingerprint of a single rdkit mol
+def fingerprint_mol(rd_mol, fp_type=None):
+    return fingerprint_mols([rd_mol], fp_type)[0]
+
+# number of uint64 words holding nbits
+def _word_count(nbits):
+    return (int(nbits) + _word_bits_ - 1) // _word_bits_
+
+# convert an rdkit ExplicitBitVect into little endian uint64 words
+def fp_to_words(fp):
+    text = DataStructs.BitVectToBinaryText(fp)
+    text += b'\0' * (-len(text) % 8)
+    return np.frombuffer(text, dtype='<u8').astype(np.uint64)
+
+# convert packed words back into an rdkit ExplicitBitVect of nbits
+def words_to_fp(words, nbits):
+    nbits = int(nbits)
+    if nbits % 8 == 0:
+        return DataStructs.CreateFromBinaryText(np.ascontiguousarray(words).tobytes()[:nbits // 8])
+    fp = DataStructs.ExplicitBitVect(nbits)
+    bits = np.unpackbits(np.ascontiguousarray(words).view(np.uint8), bitorder='little')[:nbits]
+    fp.SetBitsFromList(np.nonzero(bits)[0].tolist())
+    return fp
+
+# fold packed fingerprints (rows, nbits_from/64) down to nbits_to -- same as
+# DataStructs.FoldFingerprint where bit i goes to bit i % nbits_to
+def fold_words(words, nbits_from, nbits_to):
+    words = words[:, :_word_count(nbits_from)]
+    if nbits_from == nbits_to:
+        return words
+    nwords_to = nbits_to // _word_bits_
+    factor = nbits_from // nbits_to
+    return np.bitwise_or.reduce(words.reshape(len(words), factor, nwords_to), axis=1)
+
+class PackedFingerprints:
+    """Fingerprints packed into a (n, nbits/64) uint64 matrix with popcounts
+
+    Rows keep the size of the original fingerprint (rdkit fingerprints are
+    folded to a target density) and are stored left aligned in the matrix.
+    """
+
+    def __init__(self, nbits=2048):
+        self.nbits = nbits
+        self.nwords = _word_count(nbits)
+        self._words = np.zeros((0, self.nwords), dtype=np.uint64)
+        self._counts = np.zeros(0, dtype=np.int32)
+        self._sizes = np.zeros(0, dtype=np.int32)
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def words(self):
+        return self._words[:self._length]
+
+    @property
+    def counts(self):
+        return self._counts[:self._length]
+
+    @property
+    def sizes(self):
+        return self._sizes[:self._length]
+
+    # grow the underlying arrays by doubling so appends stay amortized O(1)
+    def _reserve(self, length):
+        capacity = len(self._words)
+        if length <= capacity:
+            return
+        capacity = max(length, 2 * capacity, 64)
+        words = np.zeros((capacity, self.nwords), dtype=np.uint64)
+        counts = np.zeros(capacity, dtype=np.int32)
+        sizes = np.zeros(capacity, dtype=np.int32)
+        words[:self._length] = self.words
+        counts[:self._length] = self.counts
+        sizes[:self._length] = self.sizes
+        (self._words, self._counts, self._sizes) = (words, counts, sizes)
+
+    def append(self, fp):
+        size = fp.GetNumBits()
+        if size > self.nbits:
+            raise ValueError("fingerprint of {} bits does not fit a {} bit store".format(size, self.nbits))
+        self._reserve(self._length + 1)
+        words = fp_to_words(fp)
+        self._words[self._length, :len(words)] = words
+        self._counts[self._length] = fp.GetNumOnBits()
+        self._sizes[self._length] = size
+        self._length += 1
+
+    def extend(self, fps):
+        for fp in fps:
+            self.append(fp)
+
+    # return a new store holding the given rows (slice or index array)
+    def take(self, rows):
+        store = PackedFingerprints(self.nbits)
+        store._words = np.ascontiguousarray(self.words[rows])
+        store._counts = np.ascontiguousarray(self.counts[rows])
+        store._sizes = np.ascontiguousarray(self.sizes[rows])
+        store._length = len(store._counts)
+        return store
+
+# below this many query rows the intersections are counted with word popcounts,
+# above it as a float32 matrix product of the unpacked bits (exact, uses BLAS)
+_matmul_rows_ = 32
+# rows unpacked at a time for the matrix product
+_matmul_block_ = 4096
+
+# unpack fingerprint words into a (rows, bits) float32 0/1 matrix
+def _unpack_bits(words):
+    return np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=1).astype(np.float32)
+
+# popcount of the intersection for every row pair of two same-size word blocks
+def _common_counts(a_words, b_words):
+    common = np.empty((len(a_words), len(b_words)), dtype=np.int32)
+    if not len(a_words) or not len(b_words):
+        return common
+    if len(a_words) < _matmul_rows_:
+        step = max(1, _block_words_ // (len(b_words) * a_words.shape[1]))
+        for start in range(0, len(a_words), step):
+            block = a_words[start:start+step, None, :] & b_words[None, :, :]
+            common[start:start+step] = _popcount(block).sum(axis=-1, dtype=np.int32)
+        return common
+    # a is unpacked once, b a block at a time
+    a_blocks = [(a_start, _unpack_bits(a_words[a_start:a_start + _matmul_block_]))
+                for a_start in range(0, len(a_words), _matmul_block_)]
+    for b_start in range(0, len(b_words), _matmul_block_):
+        b_stop = b_start + _matmul_block_
+        b_bits = _unpack_bits(b_words[b_start:b_stop])
+        for (a_start, a_bits) in a_blocks:
+            common[a_start:a_start + _matmul_block_, b_start:b_stop] = a_bits @ b_bits.T
+    return common
+
+# tanimoto between all rows of a and b -- folds differing fingerprint sizes to
+# the smaller one as DataStructs.FingerprintSimilarity does
+def _tanimoto_block(a_words, a_counts, a_sizes, b_words, b_counts, b_sizes):
+    sims = np.zeros((len(a_counts), len(b_counts)), dtype=np.float64)
+    a_groups = [(size, a_sizes == size) for size in np.unique(a_sizes)]
+    b_groups = [(size, b_sizes == size) for size in np.unique(b_sizes)]
+    for (a_size, a_rows) in a_groups:
+        for (b_size, b_rows) in b_groups:
+            size = min(a_size, b_size)
+            aw = fold_words(a_words[a_rows], a_size, size)
+            bw = fold_words(b_words[b_rows], b_size, size)
+            ac = a_counts[a_rows] if a_size == size else _popcount(aw).sum(axis=-1, dtype=np.int32)
+            bc = b_counts[b_rows] if b_size == size else _popcount(bw).sum(axis=-1, dtype=np.int32)
+            common = _common_counts(aw, bw)
+            union = ac[:, None] + bc[None, :] - common
+            sim = np.divide(common, union, out=np.zeros(union.shape), where=union > 0)
+            if len(a_groups) == 1 and len(b_groups) == 1:
+                sims = sim
+            else:
+                sims[np.ix_(a_rows, b_rows)] = sim
+    return sims
+
+# similarities between every fingerprint in fps_a and every one in fps_b
+def tanimoto_many_to_many(fps_a, fps_b):
+    return _tanimoto_block(fps_a.words, fps_a.counts, fps_a.sizes,
+                           fps_b.words, fps_b.counts, fps_b.sizes)
+
+# similarities between fingerprint index of fps_a and every one in fps_b
+def tanimoto_one_to_many(fps_a, index, fps_b):
+    rows = slice(index, index + 1 or None)
+    return _tanimoto_block(fps_a.words[rows], fps_a.counts[rows], fps_a.sizes[rows],
+                           fps_b.words, fps_b.counts, fps_b.sizes)[0]
+
+# rows of fps whose bits are a superset of the bits of fingerprint index of
+# fps_query -- the substructure pre-screen. Only the words with query bits set
+# are compared. Rows of a different size than the query can not be screened
+# and are always kept
+def superset_rows(fps_query, index, fps):
+    size = fps_query.sizes[index]
+    query = fps_query.words[index, :_word_count(size)]
+    set_words = np.nonzero(query)[0]
+    query = query[set_words]
+    rows = list()
+    step = max(1, _block_words_ // max(1, len(set_words)))
+    for start in range(0, len(fps), step):
+        words = fps.words[start:start + step, set_words]
+        keep = ((words & query) == query).all(axis=1) | (fps.sizes[start:start + step] != size)
+        rows.append(np.nonzero(keep)[0] + start)
+    if not len(rows):
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows)
+
+# truncate similarities to 3 decimals to match the reported values
+def truncate(sims):
+    return np.floor(sims * 1000) / 1000
+
+# best k matches in fps_ref for every fingerprint in fps_query -- the reference
+# set is streamed in blocks of ref_block and only the running top k is kept per
+# query so memory is O(len(fps_query) * k). Similarities are truncated to 3
+# decimals before ranking and ties go to the lower reference index. With
+# exclude_self query i is reference query_offset + i and is never matched to
+# itself. Blocks are counted in stats (BlockStats) if given. Returns a list
+# (per query) of [(ref_index, sim), ...] sorted by decreasing similarity
+def top_k_neighbours(fps_query, fps_ref, k=1, threshold=None, exclude_self=False, ref_block=4096, query_offset=0, stats=None):
+    return list(iter_top_k_neighbours(fps_query, fps_ref, k, threshold, exclude_self, ref_block, query_offset, stats))
+
+# top_k_neighbours as a generator -- the hits of each query are yielded in
+# query order as soon as its block of queries is done
+def iter_top_k_neighbours(fps_query, fps_ref, k=1, threshold=None, exclude_self=False, ref_block=4096, query_offset=0, stats=None):
+    nq = len(fps_query)
+    nr = len(fps_ref)
+    if nq == 0 or k < 1:
+        for i in range(0, nq):
+            yield list()
+        return
+    # rank on a single int64 key: truncated sim * (nr + 1) + (nr - ref_index)
+    base = nr + 1
+    ref_block = max(1, min(ref_block, nr))
+    query_block = max(1, _block_words_ // ref_block)
+    for q_start in range(0, nq, query_block):
+        q_stop = min(q_start + query_block, nq)
+        queries = fps_query.take(slice(q_start, q_stop))
+        best = np.full((q_stop - q_start, k), -1, dtype=np.int64)
+        for r_start in range(0, nr, ref_block):
+            r_stop = min(r_start + ref_block, nr)
+            sims = tanimoto_many_to_many(queries, fps_ref.take(slice(r_start, r_stop)))
+            sim_int = np.floor(sims * 1000).astype(np.int64)
+            keys = sim_int * base + (nr - np.arange(r_start, r_stop))[None, :]
+            if threshold != None:
+                keys[sim_int / 1000 < threshold] = -1
+            if exclude_self:
+                rows = np.arange(max(q_start + query_offset, r_start), min(q_stop + query_offset, r_stop))
+                keys[rows - q_start - query_offset, rows - r_start] = -1
+            candidates = np.hstack((best, keys))
+            top = np.argpartition(-candidates, k - 1, axis=1)[:, :k]
+            best = np.take_along_axis(candidates, top, axis=1)
+            if stats != None:
+                stats.block(sims.size)
+        best = -np.sort(-best, axis=1)
+        for row in best.tolist():
+            yield [(nr - key % base, (key // base) / 1000) for key in row if key >= 0]
+
+# aggregate counters of a similarity call -- pairs compared, blocks and time.
+# Only a clock read per block so they are always collected, and logged once by
+# finish when debug logging is enabled
+class BlockStats:
+    """Pair and timing counters of the similarity block loops"""
+
+    def __init__(self, name):
+        self.name = name
+        self.pairs = 0
+        self.blocks = 0
+        self.seconds = 0.0
+        self._start = time.perf_counter()
+        self._last = self._start
+
+    # count a finished block of pairs -- timed from the previous block
+    def block(self, pairs):
+        self._last = time.perf_counter()
+        self.pairs += int(pairs)
+        self.blocks += 1
+
+    def pairsPerSecond(self):
+        return self.pairs / self.seconds if self.seconds > 0 else 0.0
+
+    def secondsPerBlock(self):
+        return self.seconds / self.blocks if self.blocks else 0.0
+
+    def finish(self):
+        self.seconds = self._last - self._start
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %d pairs in %d blocks %.3f s (%.0f pairs/sec, %.6f s/block)",
+                         self.name, self.pairs, self.blocks, self.seconds, self.pairsPerSecond(), self.secondsPerBlock())
+        return self
+
+    def __repr__(self):
+        return "BlockStats({}, pairs={}, blocks={}, seconds={:.3f})".format(self.name, self.pairs, self.blocks, self.seconds)
+
+# reference fingerprints of a worker process -- set once by _init_worker
+_worker_ref_ = None
+
+def _init_worker(words, counts, sizes, nbits):
+    global _worker_ref_
+    _worker_ref_ = PackedFingerprints(nbits)
+    (_worker_ref_._words, _worker_ref_._counts, _worker_ref_._sizes) = (words, counts, sizes)
+    _worker_ref_._length = len(counts)
+
+# one chunk of queries -- query is None when the queries are the reference rows
+def _top_k_task(task):
+    (start, stop, query, k, threshold, exclude_self) = task
+    if query == None:
+        query = _worker_ref_.take(slice(start, stop))
+    return top_k_neighbours(query, _worker_ref_, k, threshold, exclude_self, query_offset=start)
+
+# top_k_neighbours with the queries split over a pool of processes. The
+# reference arrays go to each worker once as initializer arguments (inherited
+# without a copy when the pool forks) and only the query chunks are sent per
+# task. Results are returned in query order and each chunk is counted as a
+# block in stats (BlockStats) if given
+def top_k_neighbours_parallel(fps_query, fps_ref, k=1, threshold=None, exclude_self=False, processes=None, chunk_size=1024, stats=None):
+    return list(iter_top_k_neighbours_parallel(fps_query, fps_ref, k, threshold, exclude_self, processes, chunk_size, stats))
+
+# top_k_neighbours_parallel as a generator -- yields the hits of each query
+# in query order as the chunks come back from the pool
+def iter_top_k_neighbours_parallel(fps_query, fps_ref, k=1, threshold=None, exclude_self=False, processes=None, chunk_size=1024, stats=None):
+    nq = len(fps_query)
+    processes = processes if processes else multiprocessing.cpu_count()
+    tasks = list()
+    for start in range(0, nq, chunk_size):
+        stop = min(start + chunk_size, nq)
+        query = None if fps_query is fps_ref else fps_query.take(slice(start, stop))
+        tasks.append((start, stop, query, k, threshold, exclude_self))
+    logger.debug("Fingerprints.top_k_neighbours_parallel: queries: %d references: %d processes: %d chunks: %d", nq, len(fps_ref), processes, len(tasks))
+    initargs = (fps_ref.words, fps_ref.counts, fps_ref.sizes, fps_ref.nbits)
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+        for chunk in pool.imap(_top_k_task, tasks):
+            if stats != None:
+                stats.block(len(chunk) * len(fps_ref))
+            for hits in chunk:
+                yield hits
@@ -7,34 +7,399 @@ Part of the IBRI cheminformatics system
 
 Class for handling sets of molecules -- wrapper class for RDKit
 """
-import pprint
+import os
+import json
+import shutil
+import tempfile
 import logging
+import functools
+import collections
+import multiprocessing
+import numpy as np
 from chem_utils.data import core_utils
 from rdkit import Chem
+from rdkit import DataStructs
 from rdkit.Chem.Draw import rdMolDraw2D
 from rdkit.Chem import rdDepictor
-from rdkit.Chem.Fingerprints import FingerprintMols
-from rdkit import DataStructs
+from rdkit.Chem.MolStandardize import rdMolStandardize
+from chem_utils.objects import Fingerprints
+from chem_utils.objects import Clustering
 logger = logging.getLogger()
 
+# coordinates for the depictions -- set once rather than per addSmiles call
+rdDepictor.SetPreferCoordGen(True)
+
+# version of the Molecules.save directory format
+_save_version_ = 1
+
+# number of similarities computed at a time (rows x columns) by the block loops
+_block_pairs_ = 1 << 22
+
+# render the 2D depiction of an rdkit mol as svg text
+def _draw_svg(rd_mol, width=600, height=600):
+    d2d = rdMolDraw2D.MolDraw2DSVG(width, height)
+    d2d.DrawMolecule(rd_mol)
+    d2d.FinishDrawing()
+    return d2d.GetDrawingText()
+
+# parse a smiles once and return (canonical smiles, mol) -- only the mol atoms
+# are renumbered into canonical smiles order. Bond order and perception are
+# those of the input parse, so the mol is not guaranteed to be identical to a
+# parse of the canonical smiles
+def _canonical_mol(smiles):
+    rd_mol = Chem.MolFromSmiles(smiles)
+    if rd_mol == None:
+        raise ValueError("unable to parse smiles")
+    return _canonical_from_mol(rd_mol)
+
+# (canonical smiles, mol renumbered into canonical smiles atom order)
+def _canonical_from_mol(rd_mol):
+    c_smiles = Chem.MolToSmiles(rd_mol)
+    order = rd_mol.GetPropsAsDict(True, True)["_smilesAtomOutputOrder"]
+    return (c_smiles, Chem.RenumberAtoms(rd_mol, list(order)))
+
+# parse a smiles once and return (canonical smiles, mol, fingerprint)
+def parse_smiles(smiles, fp_type=None):
+    (c_smiles, cs_mol) = _canonical_mol(smiles)
+    return (c_smiles, cs_mol, Fingerprints.fingerprint_mol(cs_mol, fp_type))
+
+# parse_smiles for a list with the fingerprints computed in one batch --
+# failures are returned as the error message
+def _parse_smiles_list(smiles_list, fp_type=None):
+    results = list()
+    for smiles in smiles_list:
+        try:
+            results.append(_canonical_mol(smiles))
+        except Exception as e:
+            results.append(str(e))
+    parsed = [result for result in results if type(result) != type(str())]
+    fps = iter(Fingerprints.fingerprint_mols([result[1] for result in parsed], fp_type))
+    for i in range(0, len(results)):
+        if type(results[i]) != type(str()):
+            results[i] = results[i] + (next(fps),)
+    return results
+
+# _parse_smiles_list of a chunk of (smiles, name) records -- returns
+# (records, results) so pool results carry their records
+def _parse_records(records, fp_type=None):
+    return (records, _parse_smiles_list([record[0] for record in records], fp_type))
+
+# the next finished result of the pending pool tasks -- the oldest unless
+# ordered is False, then whichever is ready first
+def _next_result(pending, ordered):
+    if not ordered:
+        for result in pending:
+            if result.ready():
+                pending.remove(result)
+                return result.get()
+    return pending.popleft().get()
+
+# map function over chunks on a process pool with at most window chunks in
+# flight so the input is read only as fast as it is converted (Pool.imap
+# reads the whole input up front)
+def _bounded_map(function, chunks, processes, ordered=True, window=None):
+    window = window if window else 2 * processes
+    pending = collections.deque()
+    with multiprocessing.Pool(processes) as pool:
+        for chunk in chunks:
+            pending.append(pool.apply_async(function, (chunk,)))
+            if len(pending) >= window:
+                yield _next_result(pending, ordered)
+        while len(pending):
+            yield _next_result(pending, ordered)
+
+# parse_smiles over a process pool in chunks -- results in input order
+def _parse_smiles_parallel(smiles_list, processes, chunk_size=1000, fp_type=None):
+    chunks = [smiles_list[i:i+chunk_size] for i in range(0, len(smiles_list), chunk_size)]
+    parse = functools.partial(_parse_smiles_list, fp_type=fp_type)
+    with multiprocessing.Pool(processes) as pool:
+        for results in pool.imap(parse, chunks):
+            for result in results:
+                yield result
+
+# iterate over the (smiles, name) records of a smiles file -- name is None if
+# the line has no name. Reads line by line so memory does not grow with the
+# file and handles .gz/.bz2 compressed files
+def read_smi_records(in_file):
+    with core_utils.open_text_file(in_file) as file_ref:
+        for line in file_ref:
+            parts  = line.rstrip('\n').split(' ')
+            smiles = parts.pop(0)
+            if not smiles:
+                continue
+            name = None
+            if len(parts):
+                name = parts.pop(0)
+            yield (smiles, name)
+
+# iterate over the records of a smiles file in lists of chunk_size
+def read_smi_chunks(in_file, chunk_size=10000):
+    return _chunked(read_smi_records(in_file), chunk_size)
+
+# lists of up to chunk_size items of an iterable
+def _chunked(items, chunk_size):
+    chunk = list()
+    for record in items:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = list()
+    if len(chunk):
+        yield chunk
+
+# identity key types -- canonical smiles, InChIKey, canonical smiles of the
+# salt stripped (largest fragment) parent and canonical smiles of the canonical
+# tautomer of the salt stripped parent
+identity_key_types = ['smiles', 'inchikey', 'fragment', 'tautomer']
+
+# tautomer enumerator -- created once per process on first use
+_tautomer_enumerator_ = None
+
+# identity key of an rdkit mol -- molecules with the same key are identical
+# at that level. Returns "" if no key can be generated
+def molecule_key(rd_mol, key_type="smiles"):
+    global _tautomer_enumerator_
+    if key_type == "smiles":
+        return Chem.MolToSmiles(rd_mol)
+    if key_type == "inchikey":
+        return Chem.MolToInchiKey(rd_mol)
+    if key_type == "fragment" or key_type == "tautomer":
+        parent = rdMolStandardize.FragmentParent(rd_mol)
+        if key_type == "tautomer":
+            if _tautomer_enumerator_ == None:
+                _tautomer_enumerator_ = rdMolStandardize.TautomerEnumerator()
+            parent = _tautomer_enumerator_.Canonicalize(parent)
+        return Chem.MolToSmiles(parent)
+    raise ValueError("unknown identity key type \"{}\" - valid types are {}".format(key_type, identity_key_types))
+
+# molecule_key that returns "" for a mol that fails (or no mol)
+def _identity_key(rd_mol, key_type="smiles"):
+    try:
+        return molecule_key(rd_mol, key_type)
+    except Exception as e:
+        return ""
+
+# identity keys of a list of smiles -- "" for smiles that fail
+def _identity_keys(smiles_list, key_type="smiles"):
+    return [_identity_key(Chem.MolFromSmiles(smiles), key_type) for smiles in smiles_list]
+
+# _identity_keys of a chunk of (smiles, name) records -- returns
+# (records, keys) so pool results carry their records
+def _record_identity_keys(records, key_type="smiles"):
+    return (records, _identity_keys([record[0] for record in records], key_type))
+
+# iterate over (smiles, name) records as ((smiles, name), identity key) --
+# only the keys are computed (no fingerprints or depictions) in chunks of
+# chunk_size, on a process pool if processes > 1. Keys are "" for smiles that
+# fail
+def iter_identity_keys(records, key_type="smiles", processes=None, chunk_size=1000):
+    keys_of = functools.partial(_record_identity_keys, key_type=key_type)
+    chunks = _chunked(records, chunk_size)
+    if processes and processes > 1:
+        results = _bounded_map(keys_of, chunks, processes)
+    else:
+        results = map(keys_of, chunks)
+    for (chunk, keys) in results:
+        yield from zip(chunk, keys)
+
+# substructure matches of a SMARTS query against a list of rdkit mols
+def _substruct_matches(mols, smarts):
+    query = Chem.MolFromSmarts(smarts)
+    return [rd_mol.HasSubstructMatch(query) for rd_mol in mols]
+
+# iterate over the records of an sd file as (record number, mol) -- mol is
+# None for records that fail to parse. threads > 1 parses with the rdkit
+# MultithreadedSDMolSupplier, which returns records as they finish, so with
+# ordered they are buffered back into file order. The multithreaded supplier
+# only reads plain files so compressed (.gz/.bz2) files are decompressed to a
+# temporary file in tmp_dir first -- with one thread they are streamed
+def read_sdf_records(in_file, threads=1, ordered=True, tmp_dir=None, sanitize=True, removeHs=True):
+    compressed = str(in_file).endswith('.gz') or str(in_file).endswith('.bz2')
+    if not threads or threads <= 1:
+        with core_utils.open_binary_file(in_file) as file_ref:
+            for (record, mol) in enumerate(Chem.ForwardSDMolSupplier(file_ref, sanitize, removeHs), 1):
+                yield (record, mol)
+        return
+    tmp_file = None
+    if compressed:
+        with core_utils.open_binary_file(in_file) as file_ref:
+            with tempfile.NamedTemporaryFile(suffix='.sdf', dir=tmp_dir, delete=False) as tmp_ref:
+                tmp_file = tmp_ref.name
+                shutil.copyfileobj(file_ref, tmp_ref, 1 << 24)
+        logger.debug("Molecules.read_sdf_records: decompressed \"{}\" to \"{}\"".format(in_file, tmp_file))
+    try:
+        supplier = Chem.MultithreadedSDMolSupplier(tmp_file if tmp_file else str(in_file), sanitize, removeHs, True, threads)
+        pending = dict()
+        next_record = 1
+        last = None
+        for mol in supplier:
+            record = supplier.GetLastRecordId()
+            # the supplier ends with an empty record repeating the last id
+            if mol == None and record == last:
+                continue
+            last = record
+            if not ordered:
+                yield (record, mol)
+                continue
+            pending[record] = mol
+            while next_record in pending:
+                yield (next_record, pending.pop(next_record))
+                next_record += 1
+        for record in sorted(pending.keys()):
+            yield (record, pending[record])
+    finally:
+        if tmp_file:
+            os.remove(tmp_file)
+
+# name of an sd file mol -- the id_field property (spaces replaced by _) or
+# the molecule title without id_field. None if missing
+def sdf_mol_name(rd_mol, id_field=None):
+    field = id_field if id_field else "_Name"
+    if not rd_mol.HasProp(field):
+        return None
+    name = rd_mol.GetProp(field).strip().replace(' ', '_')
+    return name if name else None
+
+# write an array to a .npy file through a temporary file that replaces it --
+# a set loaded with mmap from the same path keeps reading the old file
+def _save_array(path, file_name, array):
+    tmp_file = os.path.join(path, file_name + ".tmp")
+    with open(tmp_file, "wb") as file_ref:
+        np.save(file_ref, array)
+    os.replace(tmp_file, os.path.join(path, file_name))
+
+# write a list of bytes as one uint8 blob plus int64 offsets (.npy files)
+def _save_blobs(path, name, blobs):
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(blob) for blob in blobs])
+    _save_array(path, name + "_offsets.npy", offsets)
+    _save_array(path, name + "_data.npy", np.frombuffer(b"".join(blobs), dtype=np.uint8))
+
+# read the (data, offsets) of a blob written by _save_blobs
+def _load_blobs(path, name, mmap_mode):
+    offsets = np.load(os.path.join(path, name + "_offsets.npy"), mmap_mode=mmap_mode)
+    data = np.load(os.path.join(path, name + "_data.npy"), mmap_mode=mmap_mode)
+    return (data, offsets)
+
+# molecules written by Molecules.save -- the rdkit mols and fingerprints are
+# only built when a Molecule first asks for them
+class _SavedMolecules:
+
+    def __init__(self, mols, mol_offsets, words, sizes):
+        self.mols = mols
+        self.mol_offsets = mol_offsets
+        self.words = words
+        self.sizes = sizes
+
+    def mol(self, index):
+        return Chem.Mol(self.mols[self.mol_offsets[index]:self.mol_offsets[index+1]].tobytes())
+
+    def fp(self, index):
+        return Fingerprints.words_to_fp(self.words[index], self.sizes[index])
+
+class Molecule:
+    """Single molecule of a Molecules set
+
+    Slotted record holding name, smiles, mol, fp and svg. The mol and fp of a
+    loaded set are read from the saved files on first access and the svg is
+    drawn on first access (None if the set has depict=False). Item access (mol["name"]) is kept for callers of
+    the original dict entries -- mol["svg"] is None until drawn.
+    """
+    __slots__ = ('name', 'smiles', '_mol', '_fp', '_svg', '_source', '_index', '_depict')
+    _keys_ = ('name', 'smiles', 'mol', 'fp', 'svg')
+
+    def __init__(self, name, smiles, mol=None, fp=None, source=None, index=None, depict=True):
+        self.name = name
+        self.smiles = smiles
+        self._mol = mol
+        self._fp = fp
+        self._svg = None
+        self._source = source
+        self._index = index
+        self._depict = depict
+
+    @property
+    def mol(self):
+        if self._mol == None and self._source != None:
+            self._mol = self._source.mol(self._index)
+        return self._mol
+
+    @property
+    def fp(self):
+        if self._fp == None and self._source != None:
+            self._fp = self._source.fp(self._index)
+        return self._fp
+
+    @property
+    def svg(self):
+        if not self._depict:
+            return None
+        if self._svg == None:
+            self._svg = _draw_svg(self.mol)
+        return self._svg
+
+    def __getitem__(self, key):
+        if key == "svg":
+            return self._svg
+        if key not in self._keys_:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self):
+        return "Molecule({}, {})".format(self.name, self.smiles)
+
 class Molecules:
     """Molecules List Molecules"""
 
-    def __init__(self):
+    # depict=False skips the svg depiction entirely -- otherwise it is drawn
+    # on first request through getSvg and cached on the molecule. fp_type is
+    # the fingerprint computed when molecules are added (see Fingerprints)
+    def __init__(self, depict=True, fp_type=None):
         self.molecule_list = list()
         self.count = 0
+        self.depict = depict
+        self.fp_type = fp_type if fp_type else Fingerprints.default_fp_type
+        # packed copy of the fingerprints in molecule_list order -- other
+        # fingerprint types are computed on request and cached by type
+        self.fingerprints = Fingerprints.PackedFingerprints(Fingerprints.fingerprint_bits(self.fp_type))
+        self._fp_stores = { self.fp_type : self.fingerprints }
+        # identity hash indexes by key type -- built on request
+        self._identity_indexes = dict()
+        # intra similarities by fingerprint type -- see _similarityCache
+        self._similarity_cache = dict()
+        # Fingerprints.BlockStats of the last similarity computation
+        self.similarity_stats = None
 
     def length(self):
         return len(self.molecule_list)
 
+    def __len__(self):
+        return len(self.molecule_list)
+
+    def __iter__(self):
+        return iter(self.molecule_list)
+
     # adds as either a single value or list
     # it can be a tuple of (smi, name) or just
-    def addSmiles(self, smiles):
-        rdDepictor.SetPreferCoordGen(True)
+    # with processes > 1 the smiles are parsed and fingerprinted on a pool
+    def addSmiles(self, smiles, processes=None, chunk_size=1000):
         if type(smiles) != type(list()):
             smiles = [smiles]
-        errors = list()
-        for smi in smiles:
+        # name the records in input order
+        records = list(self._namedRecords(smiles))
+        # convert to Canonical Smiles - this also checks for valid structure
+        smiles_list = [record[0] for record in records]
+        if processes and processes > 1:
+            results = _parse_smiles_parallel(smiles_list, processes, chunk_size, self.fp_type)
+        else:
+            results = _parse_smiles_list(smiles_list, self.fp_type)
+        return self._addParsed(records, results)
+
+    # (smiles, name) records of smiles or (smiles, name) items -- unnamed
+    # records get the next mol_name_ in order
+    def _namedRecords(self, items):
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for smi in items:
             # check if tuple
             name = None
             smiles = smi
@@ -43,59 +408,319 @@ class Molecules:
             if name == None:
                 name = "mol_name_{:05d}".format(self.count)
                 self.count += 1
-            logger.debug('Molecules.addSmiles: smiles: {} name: {} '.format(smiles, name))
-            # convert to Canonical Smiles - this also checks for valid structure
-            try:
-                c_smiles = Chem.CanonSmiles(smiles)
-                cs_mol   = Chem.MolFromSmiles(c_smiles)
-                fp       = FingerprintMols.FingerprintMol(cs_mol)
-                d2d      = rdMolDraw2D.MolDraw2DSVG(600,600)
-                d2d.DrawMolecule(cs_mol)
-                d2d.FinishDrawing()
-                mol = {
-                    "name" : name,
-                    "smiles" : c_smiles,
-                    "mol" : cs_mol,
-                    "fp"  : fp,
-                    "svg" : d2d.GetDrawingText()
-                }
-                self.molecule_list.append(mol)
-            except Exception as e:
+            if debug:
+                logger.debug('Molecules.addSmiles: smiles: %s name: %s', smiles, name)
+            yield (smiles, name)
+
+    # add the parse results of records (in the same order) -- returns the
+    # (smiles, name) of the records that failed
+    def _addParsed(self, records, results):
+        errors = list()
+        for ((smiles, name), result) in zip(records, results):
+            if type(result) == type(str()):
                 if not name:
                     name = "Undefined"
-                logger.error("Issue adding ({}, {}) for reason \"{}\"..skipping".format(smiles, name, e))
+                logger.error("Issue adding ({}, {}) for reason \"{}\"..skipping".format(smiles, name, result))
                 errors.append((smiles, name))
+                continue
+            (c_smiles, cs_mol, fp) = result
+            self.fingerprints.append(fp)
+            self.molecule_list.append(Molecule(name, c_smiles, cs_mol, fp, depict=self.depict))
+
+        return errors
 
+    # add rdkit mols as a list of mols or (mol, name) tuples -- unnamed mols
+    # are named as in addSmiles. Returns the indices (in the list) of the
+    # mols that could not be added
+    def addMols(self, mols):
+        if type(mols) != type(list()):
+            mols = [mols]
+        records = list()
+        errors = list()
+        for (i, item) in enumerate(mols):
+            (rd_mol, name) = item if type(item) == type(tuple()) else (item, None)
+            if name == None:
+                name = "mol_name_{:05d}".format(self.count)
+                self.count += 1
+            try:
+                if rd_mol == None:
+                    raise ValueError("no structure")
+                records.append((name,) + _canonical_from_mol(rd_mol))
+            except Exception as e:
+                logger.error("Issue adding ({}, {}) for reason \"{}\"..skipping".format(i, name, e))
+                errors.append(i)
+        fps = Fingerprints.fingerprint_mols([record[2] for record in records], self.fp_type)
+        for ((name, c_smiles, cs_mol), fp) in zip(records, fps):
+            self.fingerprints.append(fp)
+            self.molecule_list.append(Molecule(name, c_smiles, cs_mol, fp, depict=self.depict))
         return errors
 
+    # save the processed molecules (names, canonical smiles, rdkit mol pickles
+    # and packed fingerprints) into the directory path so they can be reloaded
+    # without parsing and fingerprinting again
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        fps = self.fingerprints
+        meta = {
+            "version" : _save_version_,
+            "length"  : self.length(),
+            "count"   : self.count,
+            "depict"  : self.depict,
+            "fp_type" : self.fp_type,
+            "nbits"   : fps.nbits
+        }
+        _save_blobs(path, "names", [mol.name.encode() for mol in self])
+        _save_blobs(path, "smiles", [mol.smiles.encode() for mol in self])
+        _save_blobs(path, "mols", [mol.mol.ToBinary() for mol in self])
+        _save_array(path, "fp_words.npy", fps.words)
+        _save_array(path, "fp_counts.npy", fps.counts)
+        _save_array(path, "fp_sizes.npy", fps.sizes)
+        # the meta data goes last
+        tmp_file = os.path.join(path, "molecules.json.tmp")
+        with open(tmp_file, "w") as file_ref:
+            json.dump(meta, file_ref, indent=2)
+        os.replace(tmp_file, os.path.join(path, "molecules.json"))
+        logger.info("Saved {} molecules to \"{}\"".format(self.length(), path))
+
+    # load molecules written by save -- with mmap the arrays are memory mapped
+    # rather than read into memory. The rdkit mols and fingerprints of the
+    # molecules are built on first access
+    @classmethod
+    def load(cls, path, mmap=True):
+        meta_file = os.path.join(path, "molecules.json")
+        if not core_utils.file_exists(meta_file):
+            logger.error("Unable to locate saved molecules \"{}\" .. skipping".format(path))
+            return None
+        with open(meta_file) as file_ref:
+            meta = json.load(file_ref)
+        if meta["version"] != _save_version_:
+            logger.error("Unsupported saved molecules version {} in \"{}\"".format(meta["version"], path))
+            return None
+        mmap_mode = "r" if mmap else None
+        # saves from before the fingerprint types have no fp_type (rdkit)
+        molecules = cls(depict=meta["depict"], fp_type=meta.get("fp_type", Fingerprints.default_fp_type))
+        molecules.count = meta["count"]
+        fps = Fingerprints.PackedFingerprints(meta["nbits"])
+        fps._words = np.load(os.path.join(path, "fp_words.npy"), mmap_mode=mmap_mode)
+        fps._counts = np.load(os.path.join(path, "fp_counts.npy"), mmap_mode=mmap_mode)
+        fps._sizes = np.load(os.path.join(path, "fp_sizes.npy"), mmap_mode=mmap_mode)
+        fps._length = meta["length"]
+        molecules.fingerprints = fps
+        molecules._fp_stores = { molecules.fp_type : fps }
+        (names, name_offsets) = _load_blobs(path, "names", mmap_mode)
+        (smiles, smiles_offsets) = _load_blobs(path, "smiles", mmap_mode)
+        (mols, mol_offsets) = _load_blobs(path, "mols", mmap_mode)
+        source = _SavedMolecules(mols, mol_offsets, fps.words, fps.sizes)
+        name_offsets = name_offsets.tolist()
+        smiles_offsets = smiles_offsets.tolist()
+        names = names.tobytes()
+        smiles = smiles.tobytes()
+        for i in range(0, meta["length"]):
+            name = names[name_offsets[i]:name_offsets[i+1]].decode()
+            c_smiles = smiles[smiles_offsets[i]:smiles_offsets[i+1]].decode()
+            molecules.molecule_list.append(Molecule(name, c_smiles, source=source, index=i, depict=molecules.depict))
+        logger.info("Loaded {} molecules from \"{}\"".format(molecules.length(), path))
+        return molecules
+
     # return as tuple list
     def getAllSmilesList(self):
         all = list()
-        for mol in self.molecule_list:
-            smiles = (mol["smiles"], mol["name"])
+        for mol in self:
+            smiles = (mol.smiles, mol.name)
             all.append(smiles)
         return all
 
-    # read from smiles file
-    def addFromSmiFile(self, in_file):
+    # read from smiles file (plain, .gz or .bz2) -- streamed in chunks
+    def addFromSmiFile(self, in_file, chunk_size=10000, processes=None):
+        if not core_utils.file_exists(in_file):
+            logger.error("Unable to locate file \"{}\" .. skipping".format(in_file))
+            return None
+        initial = self.length()
+        if processes and processes > 1:
+            # one pool for the whole file -- every chunk is spread over all
+            # the processes and the results are added as they arrive
+            task_size = max(1, chunk_size // (4 * processes))
+            tasks = _chunked(self._namedRecords(read_smi_records(in_file)), task_size)
+            parse = functools.partial(_parse_records, fp_type=self.fp_type)
+            for (records, results) in _bounded_map(parse, tasks, processes):
+                self._addParsed(records, results)
+        else:
+            for chunk in read_smi_chunks(in_file, chunk_size):
+                self.addSmiles(chunk)
+
+        number_added = self.length() - initial
+        logger.info("Added {} molecules from file \"{}\"".format(number_added, in_file))
+
+    # read from an sd file (plain, .gz or .bz2) in chunks -- the name is the
+    # id_field property (the molecule title without id_field). threads > 1
+    # parses with the rdkit multithreaded supplier (see read_sdf_records)
+    def addFromSdfFile(self, in_file, id_field=None, threads=1, ordered=True, chunk_size=10000, tmp_dir=None):
         if not core_utils.file_exists(in_file):
             logger.error("Unable to locate file \"{}\" .. skipping".format(in_file))
             return None
         initial = self.length()
-        with open(in_file) as file_ref:
-            for line in file_ref.readlines():
-                parts  = line.rstrip('\n').split(' ')
-                smiles = parts.pop(0)
-                name = None
-                if len(parts):
-                    name = parts.pop(0)
-                self.addSmiles((smiles, name))
+        chunk = list()
+        for (record, rd_mol) in read_sdf_records(in_file, threads, ordered, tmp_dir):
+            if rd_mol == None:
+                logger.error("Issue adding record {} of \"{}\" for reason \"unable to parse\"..skipping".format(record, in_file))
+                continue
+            chunk.append((rd_mol, sdf_mol_name(rd_mol, id_field)))
+            if len(chunk) >= chunk_size:
+                self.addMols(chunk)
+                chunk = list()
+        self.addMols(chunk)
 
         number_added = self.length() - initial
         logger.info("Added {} molecules from file \"{}\"".format(number_added, in_file))
-        file_ref.close()
 
-    # get moleule by index -- surrogate for iterator TODO: Generate Iterator function
+    # packed fingerprints of fp_type (default the set fp_type) in molecule
+    # order -- other types are computed in batch on first request and cached
+    def getFingerprints(self, fp_type=None, num_threads=1):
+        fp_type = fp_type if fp_type else self.fp_type
+        if fp_type not in self._fp_stores:
+            self._fp_stores[fp_type] = Fingerprints.PackedFingerprints(Fingerprints.fingerprint_bits(fp_type))
+        store = self._fp_stores[fp_type]
+        if len(store) < self.length():
+            mols = [mol.mol for mol in self.molecule_list[len(store):]]
+            logger.debug("Molecules.getFingerprints: computing {} {} fingerprints".format(len(mols), fp_type))
+            store.extend(Fingerprints.fingerprint_mols(mols, fp_type, num_threads))
+        return store
+
+    # identity keys for the molecules from start on -- the canonical smiles are
+    # used as is, other key types can be split over a process pool
+    def _identityKeys(self, key_type, start=0, processes=None, chunk_size=1000):
+        new = self.molecule_list[start:]
+        if key_type == "smiles":
+            return [mol.smiles for mol in new]
+        logger.debug("Molecules._identityKeys: computing {} {} keys".format(len(new), key_type))
+        if processes and processes > 1:
+            smiles_list = [mol.smiles for mol in new]
+            chunks = [smiles_list[i:i+chunk_size] for i in range(0, len(smiles_list), chunk_size)]
+            keys = list()
+            with multiprocessing.Pool(processes) as pool:
+                for chunk_keys in pool.imap(functools.partial(_identity_keys, key_type=key_type), chunks):
+                    keys.extend(chunk_keys)
+            return keys
+        return [_identity_key(mol.mol, key_type) for mol in new]
+
+    # hash index of identity key -> list of molecule indices for key_type (see
+    # identity_key_types) -- built on first request and extended as molecules
+    # are added
+    def getIdentityIndex(self, key_type="smiles", processes=None):
+        if key_type not in identity_key_types:
+            logger.error("Molecules.getIdentityIndex: unknown key type \"{}\" - valid types are {}".format(key_type, identity_key_types))
+            return None
+        if key_type not in self._identity_indexes:
+            self._identity_indexes[key_type] = { "index" : dict(), "length" : 0 }
+        entry = self._identity_indexes[key_type]
+        if entry["length"] < self.length():
+            start = entry["length"]
+            keys = self._identityKeys(key_type, start, processes)
+            for (i, key) in enumerate(keys, start):
+                if key:
+                    entry["index"].setdefault(key, list()).append(i)
+            entry["length"] = self.length()
+        return entry["index"]
+
+    # names of the molecules identical to a query smiles (or (smiles, name)
+    # tuple) at the key_type level
+    def findIdentical(self, query, key_type="smiles"):
+        index = self.getIdentityIndex(key_type)
+        if index == None:
+            return None
+        smiles = query[0] if type(query) == type(tuple()) else query
+        rd_mol = Chem.MolFromSmiles(smiles)
+        if rd_mol == None:
+            logger.error("Molecules.findIdentical: unable to parse query smiles \"{}\"".format(smiles))
+            return None
+        key = molecule_key(rd_mol, key_type)
+        return [self.molecule_list[j].name for j in index.get(key, list())]
+
+    # identical molecules in mol_ref for every molecule in this set -- a hash
+    # join on the key_type identity keys. Returns a list of
+    # (name, [ref_name, ...]) in molecule order
+    def matchIdentical(self, mol_ref, key_type="smiles", processes=None):
+        index = mol_ref.getIdentityIndex(key_type, processes)
+        if index == None:
+            return None
+        logger.debug("Molecules.matchIdentical: len: {} compared_to: {} key: {}".format(self.length(), mol_ref.length(), key_type))
+        keys = self._identityKeys(key_type, processes=processes)
+        matches = list()
+        for (mol, key) in zip(self.molecule_list, keys):
+            rows = index.get(key, list()) if key else list()
+            matches.append((mol.name, [mol_ref.molecule_list[j].name for j in rows]))
+        return matches
+
+    # names of the molecules matching a SMARTS query -- the 'pattern'
+    # fingerprints screen out molecules that can not match so the substructure
+    # match only runs on the survivors, split over a process pool if
+    # processes > 1
+    def substructureSearch(self, smarts, processes=None, chunk_size=1000):
+        query = Chem.MolFromSmarts(smarts)
+        if query == None:
+            logger.error("Molecules.substructureSearch: unable to parse smarts \"{}\"".format(smarts))
+            return None
+        query.UpdatePropertyCache(strict=False)
+        query_fps = Fingerprints.PackedFingerprints(Fingerprints.fingerprint_bits('pattern'))
+        query_fps.append(Fingerprints.fingerprint_mol(query, 'pattern'))
+        candidates = Fingerprints.superset_rows(query_fps, 0, self.getFingerprints('pattern')).tolist()
+        logger.debug("Molecules.substructureSearch: smarts: {} candidates: {} of {}".format(smarts, len(candidates), self.length()))
+        mols = [self.molecule_list[j].mol for j in candidates]
+        if processes and processes > 1 and len(mols) > chunk_size:
+            chunks = [mols[i:i+chunk_size] for i in range(0, len(mols), chunk_size)]
+            matched = list()
+            with multiprocessing.Pool(processes) as pool:
+                for chunk_matched in pool.imap(functools.partial(_substruct_matches, smarts=smarts), chunks):
+                    matched.extend(chunk_matched)
+        else:
+            matched = [rd_mol.HasSubstructMatch(query) for rd_mol in mols]
+        return [self.molecule_list[j].name for (j, match) in zip(candidates, matched) if match]
+
+    # remove molecules by index (or list of indices) -- the fingerprint stores
+    # are compacted and the identity indexes and cached similarities dropped
+    def removeMolecules(self, indices):
+        if type(indices) != type(list()):
+            indices = [indices]
+        n = self.length()
+        remove = set()
+        for index in indices:
+            if index < -n or index >= n:
+                logger.error("Molecules.removeMolecules: Unable to remove molecule index \"{}\" - valid indices are -{} to {}".format(index, n-1, n-1))
+                continue
+            remove.add(index % n)
+        keep = [i for i in range(0, n) if i not in remove]
+        self.molecule_list = [self.molecule_list[i] for i in keep]
+        for fp_type in list(self._fp_stores.keys()):
+            store = self._fp_stores[fp_type]
+            rows = np.array([i for i in keep if i < len(store)], dtype=np.int64)
+            self._fp_stores[fp_type] = store.take(rows)
+        self.fingerprints = self._fp_stores[self.fp_type]
+        self._dropCaches()
+        logger.debug("Molecules.removeMolecules: removed {} molecules".format(len(remove)))
+
+    # drop the identity indexes and cached similarities
+    def _dropCaches(self):
+        self._identity_indexes = dict()
+        self._similarity_cache = dict()
+
+    # rebuild the fingerprints from molecule_list and drop the identity indexes
+    # and cached similarities -- needed after the molecules in molecule_list
+    # are changed directly rather than through addSmiles or removeMolecules.
+    # Fingerprints of other types than the set fp_type are recomputed on the
+    # next getFingerprints
+    def invalidateCaches(self):
+        fps = Fingerprints.PackedFingerprints(Fingerprints.fingerprint_bits(self.fp_type))
+        for mol in self.molecule_list:
+            fp = mol.fp
+            if fp == None:
+                fp = Fingerprints.fingerprint_mol(mol.mol, self.fp_type)
+                mol._fp = fp
+            fps.append(fp)
+        self.fingerprints = fps
+        self._fp_stores = { self.fp_type : fps }
+        self._dropCaches()
+
+    # get moleule by index -- the set can also be iterated over directly
     def getMol(self, index):
         try:
             mol = self.molecule_list[index]
@@ -104,88 +729,265 @@ class Molecules:
             logger.error("Molecules.getMol: Unable to get molecule index \"{}\" - valid indices are -{} to {}".format(index, self.length()-1, self.length()-1))
             return None
 
-    def getIntraSimilarityMatrix(self):
+    # get the svg depiction by index -- drawn on first request and cached
+    def getSvg(self, index):
+        mol = self.getMol(index)
+        if mol == None:
+            return None
+        if not self.depict:
+            logger.debug("Molecules.getSvg: depiction disabled for this set")
+            return None
+        return mol.svg
+
+    # row blocks sized so that a block against ncols stays within _block_pairs_
+    def _row_blocks(self, nrows, ncols):
+        step = max(1, _block_pairs_ // max(1, ncols))
+        for start in range(0, nrows, step):
+            yield (start, min(start + step, nrows))
+
+    # intra similarities of fp_type as integer thousandths (the 3 decimal
+    # truncated values) of the lower triangle in row order -- row j holds the
+    # similarities to molecules 0..j-1 starting at j*(j-1)/2, so molecules added
+    # since the last call only add rows and only the new vs existing and new
+    # vs new similarities are computed. Returns the uint16 array
+    def _similarityCache(self, fp_type=None):
+        fp_type = fp_type if fp_type else self.fp_type
+        fps = self.getFingerprints(fp_type)
+        n = self.length()
+        if fp_type not in self._similarity_cache:
+            self._similarity_cache[fp_type] = { "sims" : np.zeros(0, dtype=np.uint16), "length" : 0 }
+        cache = self._similarity_cache[fp_type]
+        start = cache["length"]
+        if start < n:
+            size = n * (n - 1) // 2
+            if len(cache["sims"]) < size:
+                # grow by doubling so repeated small appends stay cheap
+                sims = np.zeros(max(size, 2 * len(cache["sims"])), dtype=np.uint16)
+                sims[:start * (start - 1) // 2] = cache["sims"][:start * (start - 1) // 2]
+                cache["sims"] = sims
+            logger.debug("Molecules._similarityCache: fp_type: %s cached: %d new: %d", fp_type, start, n - start)
+            stats = Fingerprints.BlockStats("Molecules._similarityCache")
+            for (block_start, block_stop) in self._row_blocks(n - start, n):
+                (first, last) = (start + block_start, start + block_stop)
+                sims = Fingerprints.tanimoto_many_to_many(fps.take(slice(first, last)), fps.take(slice(0, last)))
+                lower = np.arange(last)[None, :] < np.arange(first, last)[:, None]
+                cache["sims"][first * (first - 1) // 2:last * (last - 1) // 2] = np.floor(sims[lower] * 1000)
+                stats.block(sims.size)
+            cache["length"] = n
+            self.similarity_stats = stats.finish()
+        return cache["sims"]
+
+    # full similarity row i (float64, 1.0 on the diagonal) from the cache
+    def _similarityRow(self, sims, i, n):
+        tri = np.arange(i + 1, n, dtype=np.int64)
+        row = np.empty(n, dtype=np.float64)
+        row[:i] = sims[i * (i - 1) // 2:i * (i - 1) // 2 + i]
+        row[i] = 1000
+        row[i + 1:] = sims[tri * (tri - 1) // 2 + i]
+        return row / 1000
+
+    # drop the cached intra similarities of fp_type (all types if not given)
+    def releaseSimilarityCache(self, fp_type=None):
+        if fp_type == None:
+            self._similarity_cache = dict()
+        else:
+            self._similarity_cache.pop(fp_type, None)
+
+    # the cached similarities (see _similarityCache) if cache is set or they
+    # are already kept for fp_type -- otherwise None
+    def _cachedSimilarities(self, fp_type, cache):
+        fp_type = fp_type if fp_type else self.fp_type
+        if cache or fp_type in self._similarity_cache:
+            return self._similarityCache(fp_type)
+        return None
+
+    # mode "dict" returns the dict[name][name] matrix, "condensed" returns a
+    # float32 upper triangle (scipy squareform order) and "dense" a symmetric
+    # float32 matrix -- the array modes return (matrix, name_list). With cache
+    # the similarities are kept (N(N-1)/2 uint16) so calls after adding
+    # molecules only compute the new ones, until releaseSimilarityCache
+    def getIntraSimilarityMatrix(self, mode="dict", fp_type=None, cache=False):
+        if mode == "condensed" or mode == "dense":
+            return self._getIntraSimilarityArray(mode, fp_type, cache)
+        if mode != "dict":
+            logger.error("Molecules.getIntraSimilarityMatrix: unknown mode \"{}\" - use dict, condensed or dense".format(mode))
+            return None
         # set up lists and dictionaries
-        logger.debug("Molecules.getSimilarityMatrix: len: {}".format(self.length()))
+        logger.debug("Molecules.getSimilarityMatrix: len: %d", self.length())
         name_list = list()
         similarity_matrix = dict()
-        for mol in self.molecule_list:
-            similarity_matrix[mol["name"]] = dict()
-            name_list.append(mol["name"])
-        # compute similarities -- lower triangle and reflect
-        for i in range(0, len(self.molecule_list)):
-            mol_i = self.molecule_list[i]
-            similarity_matrix[mol_i["name"]][mol_i["name"]] = 1.0
-            for j in range(i+1, len(self.molecule_list)):
-                mol_j = self.molecule_list[j]
-                #sim = compare_molecules.compute_similarity(mol_i["smiles"], mol_j["smiles"])
-                sim = DataStructs.FingerprintSimilarity(mol_i["fp"], mol_j["fp"])
-                sim = float(int(sim*1000)/1000) # truncate to 3 decimals
-                similarity_matrix[mol_i["name"]][mol_j["name"]] = sim
-                similarity_matrix[mol_j["name"]][mol_i["name"]] = sim
-                logger.debug("Molecules.getIntraSimilarities: i j name_i name_j sim: {} {} {} {} {}".format(i,j,mol_i["name"],mol_j["name"],sim))
-
-        logger.debug("Molecules.getIntraSimilarities: matrix: {}".format(pprint.pformat(similarity_matrix)))
+        for mol in self:
+            similarity_matrix[mol.name] = dict()
+            name_list.append(mol.name)
+        n = self.length()
+        sims = self._cachedSimilarities(fp_type, cache)
+        if sims is not None:
+            # fill the rows from the cached similarities
+            for i in range(0, n):
+                row = self._similarityRow(sims, i, n).tolist()
+                similarity_matrix[name_list[i]].update(zip(name_list, row))
+            return similarity_matrix
+        # or straight from full row blocks
+        fps = self.getFingerprints(fp_type)
+        stats = Fingerprints.BlockStats("Molecules.getIntraSimilarityMatrix")
+        for (start, stop) in self._row_blocks(n, n):
+            block = Fingerprints.truncate(Fingerprints.tanimoto_many_to_many(fps.take(slice(start, stop)), fps))
+            rows = np.arange(stop - start)
+            block[rows, rows + start] = 1.0
+            stats.block(block.size)
+            for i in range(start, stop):
+                similarity_matrix[name_list[i]].update(zip(name_list, block[i - start].tolist()))
+        self.similarity_stats = stats.finish()
         return similarity_matrix
 
+    # condensed or dense float32 similarity matrix -- filled row by row from
+    # the cached lower triangle, or without a cache straight from blocks of
+    # the upper triangle
+    def _getIntraSimilarityArray(self, mode, fp_type=None, cache=False):
+        n = self.length()
+        name_list = [mol.name for mol in self]
+        sims = self._cachedSimilarities(fp_type, cache)
+        if sims is None:
+            return (self._intraSimilarityArray(mode, fp_type), name_list)
+        if mode == "dense":
+            matrix = np.ones((n, n), dtype=np.float32)
+            for i in range(1, n):
+                row = sims[i * (i - 1) // 2:i * (i - 1) // 2 + i] / 1000
+                matrix[i, :i] = row
+                matrix[:i, i] = row
+        else:
+            matrix = np.zeros(n * (n - 1) // 2, dtype=np.float32)
+            tri = np.arange(n, dtype=np.int64)
+            tri = tri * (tri - 1) // 2
+            for i in range(0, n - 1):
+                offset = i * n - i * (i + 1) // 2
+                matrix[offset:offset + n - i - 1] = sims[tri[i + 1:] + i] / 1000
+        logger.debug("Molecules.getIntraSimilarityMatrix: mode: %s len: %d bytes: %d", mode, n, matrix.nbytes)
+        return (matrix, name_list)
+
+    # condensed or dense float32 matrix computed block by block -- only the
+    # upper triangle is computed and written straight into the result array
+    def _intraSimilarityArray(self, mode, fp_type=None):
+        n = self.length()
+        fps = self.getFingerprints(fp_type)
+        if mode == "dense":
+            matrix = np.ones((n, n), dtype=np.float32)
+        else:
+            matrix = np.zeros(n * (n - 1) // 2, dtype=np.float32)
+        stats = Fingerprints.BlockStats("Molecules.getIntraSimilarityMatrix")
+        for (start, stop) in self._row_blocks(n, n):
+            sims = Fingerprints.truncate(Fingerprints.tanimoto_many_to_many(fps.take(slice(start, stop)), fps.take(slice(start, n))))
+            stats.block(sims.size)
+            for i in range(start, stop):
+                row = sims[i - start, i - start + 1:]
+                if mode == "dense":
+                    matrix[i, i+1:] = row
+                    matrix[i+1:, i] = row
+                else:
+                    offset = i * n - i * (i + 1) // 2
+                    matrix[offset:offset + len(row)] = row
+        self.similarity_stats = stats.finish()
+        logger.debug("Molecules.getIntraSimilarityMatrix: mode: %s len: %d bytes: %d", mode, n, matrix.nbytes)
+        return matrix
+
+    # cluster the set at a distance (1 - similarity) threshold -- "butina"
+    # keeps the neighbour lists in memory, "leader" (sphere exclusion) only
+    # compares against the cluster centroids for very large sets. Returns
+    # (cluster_ids, centroids) -- the cluster of every molecule in molecule
+    # order and the molecule index of every cluster centroid. Runs in this
+    # process only -- no processes argument as addSmiles
+    def cluster(self, threshold=0.35, method="butina", fp_type=None):
+        methods = {
+            "butina" : Clustering.butina_clusters,
+            "leader" : Clustering.leader_clusters
+        }
+        if method not in methods:
+            logger.error("Molecules.cluster: unknown method \"{}\" - valid methods are {}".format(method, list(methods.keys())))
+            return None
+        logger.debug("Molecules.cluster: len: {} method: {} threshold: {}".format(self.length(), method, threshold))
+        return methods[method](self.getFingerprints(fp_type), threshold)
+
+    # pick n_picks diverse molecules by MaxMin -- seeds are molecule indices
+    # already selected and mol_ref a Molecules set of an existing selection,
+    # both count as picked. Returns the molecule indices of the new picks in
+    # pick order
+    def pickDiverse(self, n_picks, seeds=None, mol_ref=None, fp_type=None):
+        logger.debug("Molecules.pickDiverse: len: {} picks: {}".format(self.length(), n_picks))
+        fp_type = fp_type if fp_type else self.fp_type
+        seed_fps = mol_ref.getFingerprints(fp_type) if mol_ref != None else None
+        return Clustering.maxmin_pick(self.getFingerprints(fp_type), n_picks, seeds, seed_fps)
+
+    # the k most similar molecules of this set to a query smiles (or (smiles,
+    # name) tuple) as a list of (name, sim) -- only hits with sim >= threshold
+    def nearest(self, query, k=1, threshold=None, fp_type=None):
+        smiles = query[0] if type(query) == type(tuple()) else query
+        rd_mol = Chem.MolFromSmiles(smiles)
+        if rd_mol == None:
+            logger.error("Molecules.nearest: unable to parse query smiles \"{}\"".format(smiles))
+            return None
+        fps = self.getFingerprints(fp_type)
+        query_fps = Fingerprints.PackedFingerprints(fps.nbits)
+        query_fps.append(Fingerprints.fingerprint_mol(rd_mol, fp_type if fp_type else self.fp_type))
+        hits = Fingerprints.top_k_neighbours(query_fps, fps, k, threshold)[0]
+        return [(self.molecule_list[j].name, sim) for (j, sim) in hits]
+
+    # the k most similar molecules in mol_ref for every molecule in this set --
+    # against itself (excluding the molecule) when mol_ref is not given. With
+    # processes > 1 the molecules are split over a process pool. Returns a list
+    # of (name, [(ref_name, sim), ...]) in molecule order
+    def nearestAll(self, k=1, mol_ref=None, threshold=None, processes=None, fp_type=None):
+        return list(self.iterNearestAll(k, mol_ref, threshold, processes, fp_type))
+
+    # nearestAll as a generator -- (name, [(ref_name, sim), ...]) is yielded in
+    # molecule order as each block of molecules is done so memory stays flat
+    def iterNearestAll(self, k=1, mol_ref=None, threshold=None, processes=None, fp_type=None):
+        exclude_self = mol_ref == None
+        if mol_ref == None:
+            mol_ref = self
+        logger.debug("Molecules.nearestAll: len: %d compared_to: %d k: %d", self.length(), mol_ref.length(), k)
+        fp_type = fp_type if fp_type else self.fp_type
+        fps = self.getFingerprints(fp_type)
+        ref_fps = mol_ref.getFingerprints(fp_type)
+        stats = Fingerprints.BlockStats("Molecules.nearestAll")
+        if processes and processes > 1:
+            neighbours = Fingerprints.iter_top_k_neighbours_parallel(fps, ref_fps, k, threshold, exclude_self, processes, stats=stats)
+        else:
+            neighbours = Fingerprints.iter_top_k_neighbours(fps, ref_fps, k, threshold, exclude_self, stats=stats)
+        for (mol, hits) in zip(self.molecule_list, neighbours):
+            yield (mol.name, [(mol_ref.molecule_list[j].name, sim) for (j, sim) in hits])
+        self.similarity_stats = stats.finish()
+
+    # the single best match per molecule as (name_1, max_name, max_sim) --
+    # max_name and max_sim are None if there is no match
+    def _iterBestMatches(self, nearest_all):
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for (name_1, hits) in nearest_all:
+            (max_name, max_sim) = hits[0] if len(hits) else (None, None)
+            if debug:
+                logger.debug("Molecules._iterBestMatches: name_1 max_name max_sim: %s %s %s", name_1, max_name, max_sim)
+            yield (name_1, max_name, max_sim)
+
+    # format the single best match per molecule as "name_1 max_name max_sim"
+    def _formatBestMatches(self, nearest_all):
+        return ["{} {} {}".format(*match) for match in self._iterBestMatches(nearest_all)]
 
     # compute intra molecule list similarities
-    def getIntraSimilarities(self):
-        # set up lists and dictionaries
-        logger.debug("Molecules.getIntraSimilarities: len: {}".format(self.length()))
-        name_list = list()
-        similarity_matrix = self.getIntraSimilarityMatrix()
-        for mol in self.molecule_list:
-            name_list.append(mol["name"])
-
-        # generate into a list of mol_i mol_j sim
-        similarities = list()
-        for name_1 in name_list:
-            max_name = None
-            max_sim = None
-            for name_2 in similarity_matrix[name_1].keys():
-                if name_1 != name_2:
-                    if max_sim == None or similarity_matrix[name_1][name_2] > max_sim:
-                        max_name = name_2
-                        max_sim = similarity_matrix[name_1][name_2]
-                logger.debug("Molecules.getIntraSimilarities: name_1 name_2 sim max_name max_sim: {} {} {} {} {}".format(name_1, name_2, similarity_matrix[name_1][name_2], max_name, max_sim))
-            logger.debug("Molecules.getIntraSimilarities: name_1 max_name max_sim: {} {} {} ".format(name_1, max_name, max_sim))
-            similarities.append("{} {} {}".format(name_1, max_name, max_sim))
-
-        return similarities
-
-    # compute inter molecule list similarities
-    def getInterSimilarities(self, mol_ref):
-        # set up lists and dictionaries
-        logger.debug("Molecules.getInterSimilarities: len: {} compared_to: {}".format(self.length(), mol_ref.length()))
-        name_list = list()
-        similarity_matrix = dict()
-        for mol in self.molecule_list:
-            similarity_matrix[mol["name"]] = dict()
-            name_list.append(mol["name"])
-        # compute similarities -- lower triangle and reflect
-        for i in range(0, len(self.molecule_list)):
-            mol_i = self.molecule_list[i]
-            for j in range(0, mol_ref.length()):
-                mol_j = mol_ref.getMol(j)
-#                sim = compare_molecules.compute_similarity(mol_i["smiles"], mol_j["smiles"])
-                sim = DataStructs.FingerprintSimilarity(mol_i["fp"], mol_j["fp"])
-                sim = float(int(sim*1000)/1000) # truncate to 3 decimals
-                similarity_matrix[mol_i["name"]][mol_j["name"]] = sim
-                logger.debug("Molecules.getInterSimilarities: i j name_i name_j sim: {} {} {} {} {}".format(i,j,mol_i["name"],mol_j["name"],sim))
-
-        logger.debug("Molecules.getInterSimilarities: matrix: {}".format(pprint.pformat(similarity_matrix)))
-        # generate into a list of mol_i mol_j sim
-        similarities = list()
-        for name_1 in name_list:
-            max_name = None
-            max_sim = None
-            for name_2 in similarity_matrix[name_1].keys():
-                if max_sim == None or similarity_matrix[name_1][name_2] > max_sim:
-                    max_name = name_2
-                    max_sim = similarity_matrix[name_1][name_2]
-                logger.debug("Molecules.getIntraSimilarities: name_1 name_2 sim max_name max_sim: {} {} {} {} {}".format(name_1, name_2, similarity_matrix[name_1][name_2], max_name, max_sim))
-            logger.debug("Molecules.getInterSimilarities: name_1 max_name max_sim: {} {} {} ".format(name_1, max_name, max_sim))
-            similarities.append("{} {} {}".format(name_1, max_name, max_sim))
-
-        return similarities
+    def getIntraSimilarities(self, processes=None, fp_type=None):
+        logger.debug("Molecules.getIntraSimilarities: len: %d", self.length())
+        return self._formatBestMatches(self.iterNearestAll(k=1, processes=processes, fp_type=fp_type))
+
+    # compute inter molecule list similarities -- processes > 1 runs on a pool
+    def getInterSimilarities(self, mol_ref, processes=None, fp_type=None):
+        logger.debug("Molecules.getInterSimilarities: len: %d compared_to: %d", self.length(), mol_ref.length())
+        return self._formatBestMatches(self.iterNearestAll(k=1, mol_ref=mol_ref, processes=processes, fp_type=fp_type))
+
+    # getIntraSimilarities as a generator of (name_1, max_name, max_sim)
+    # tuples -- yielded as they are computed
+    def iterIntraSimilarities(self, processes=None, fp_type=None):
+        logger.debug("Molecules.iterIntraSimilarities: len: %d", self.length())
+        return self._iterBestMatches(self.iterNearestAll(k=1, processes=processes, fp_type=fp_type))
+
+    # getInterSimilarities as a generator of (name_1, max_name, max_sim) tuples
+    def iterInterSimilarities(self, mol_ref, processes=None, fp_type=None):
+        logger.debug("Molecules.iterInterSimilarities: len: %d compared_to: %d", self.length(), mol_ref.length())
+        return self._iterBestMatches(self.iterNearestAll(k=1, mol_ref=mol_ref, processes=processes, fp_type=fp_type))
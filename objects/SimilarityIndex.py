@@ -0,0 +1,161 @@
+"""
+SimilarityIndex.py
+------------
+Author: Daniel H Robertson
+
+Part of the IBRI cheminformatics system
+
+Popcount bucketed fingerprint index for thresholded similarity searches. Uses
+the Swamidass-Baldi bound -- a query with a bits set can only reach a tanimoto
+of t against fingerprints with between t*a and a/t bits set -- so only those
+buckets are compared.
+"""
+import math
+import logging
+import numpy as np
+from rdkit import Chem
+from chem_utils.objects import Fingerprints
+logger = logging.getLogger()
+
+# slack on the popcount bounds so floating point never drops a real hit
+_bound_eps_ = 1e-9
+
+# range of popcounts that can reach threshold against a query with count bits
+def popcount_bounds(count, threshold):
+    if threshold == None or threshold <= 0:
+        return (0, np.iinfo(np.int32).max)
+    lower = int(math.ceil(threshold * count - _bound_eps_))
+    upper = int(math.floor(count / threshold + _bound_eps_))
+    return (lower, upper)
+
+class SimilarityIndex:
+    """Similarity index built from a Molecules set
+
+    Fingerprints are grouped by fingerprint size and sorted by popcount within
+    each group, so the candidates for a threshold are a contiguous range.
+    """
+
+    def __init__(self, molecules=None, fp_type=None):
+        self.names = list()
+        self.classes = list()
+        self.last_compared = 0
+        self.fp_type = fp_type
+        if molecules != None:
+            self.fp_type = fp_type if fp_type else molecules.fp_type
+            self._build(molecules.getFingerprints(self.fp_type), [mol.name for mol in molecules])
+
+    def __len__(self):
+        return len(self.names)
+
+    def _build(self, fps, names):
+        self.names = list(names)
+        # a copy -- the store of a Molecules set keeps growing as molecules
+        # are added (and may be memory mapped)
+        fps = fps.take(np.arange(len(self.names)))
+        self.fingerprints = fps
+        self.classes = list()
+        for size in np.unique(fps.sizes):
+            rows = np.nonzero(fps.sizes == size)[0]
+            order = rows[np.argsort(fps.counts[rows], kind='stable')]
+            self.classes.append({
+                "size" : int(size),
+                "rows" : order,
+                "fps"  : fps.take(order),
+                "folded_counts" : dict()
+            })
+        logger.debug("SimilarityIndex._build: len: {} size classes: {}".format(len(self.names), [c["size"] for c in self.classes]))
+
+    # popcounts of a size class folded down to a smaller query size -- cached
+    def _foldedCounts(self, size_class, size):
+        if size not in size_class["folded_counts"]:
+            fps = size_class["fps"]
+            folded = Fingerprints.fold_words(fps.words, size_class["size"], size)
+            size_class["folded_counts"][size] = Fingerprints._popcount(folded).sum(axis=-1, dtype=np.int32)
+        return size_class["folded_counts"][size]
+
+    # query as smiles, (smiles, name) tuple or rdkit fingerprint
+    def _queryFingerprints(self, query):
+        fp = query
+        if type(query) == type(tuple()) or type(query) == type(str()):
+            smiles = query[0] if type(query) == type(tuple()) else query
+            rd_mol = Chem.MolFromSmiles(smiles)
+            if rd_mol == None:
+                logger.error("SimilarityIndex.search: unable to parse query smiles \"{}\"".format(smiles))
+                return None
+            fp = Fingerprints.fingerprint_mol(rd_mol, self.fp_type)
+        query_fps = Fingerprints.PackedFingerprints(self.fingerprints.nbits)
+        query_fps.append(fp)
+        return query_fps
+
+    # all molecules with similarity >= threshold to the query as a list of
+    # (name, sim) sorted by decreasing similarity
+    def search(self, query, threshold=0.7):
+        query_fps = self._queryFingerprints(query)
+        if query_fps == None:
+            return None
+        return [(self.names[j], sim) for (j, sim) in self._search(query_fps, threshold)]
+
+    def _search(self, query_fps, threshold):
+        query_size = int(query_fps.sizes[0])
+        hits = list()
+        self.last_compared = 0
+        for size_class in self.classes:
+            size = size_class["size"]
+            fps = size_class["fps"]
+            if size <= query_size:
+                # class fingerprints are compared as is -- contiguous range
+                count = Fingerprints._popcount(Fingerprints.fold_words(query_fps.words, query_size, size)).sum()
+                (lower, upper) = popcount_bounds(count, threshold)
+                start = np.searchsorted(fps.counts, lower, side='left')
+                stop = np.searchsorted(fps.counts, upper, side='right')
+                candidates = np.arange(start, stop)
+            else:
+                # class fingerprints get folded to the query size first
+                (lower, upper) = popcount_bounds(query_fps.counts[0], threshold)
+                folded_counts = self._foldedCounts(size_class, query_size)
+                candidates = np.nonzero((folded_counts >= lower) & (folded_counts <= upper))[0]
+            if not len(candidates):
+                continue
+            self.last_compared += len(candidates)
+            sims = Fingerprints.truncate(Fingerprints.tanimoto_one_to_many(query_fps, 0, fps.take(candidates)))
+            keep = sims >= threshold if threshold != None else np.ones(len(sims), dtype=bool)
+            hits.extend(zip(size_class["rows"][candidates[keep]].tolist(), sims[keep].tolist()))
+        logger.debug("SimilarityIndex.search: compared {} of {}".format(self.last_compared, len(self.names)))
+        hits.sort(key=lambda hit: (-hit[1], hit[0]))
+        return hits
+
+    # search every molecule of a Molecules set -- returns a list of
+    # (name, [(name, sim), ...]) in molecule order
+    def searchMolecules(self, molecules, threshold=0.7):
+        results = list()
+        compared = 0
+        for i in range(0, molecules.length()):
+            query_fps = molecules.getFingerprints(self.fp_type).take(slice(i, i + 1))
+            hits = self._search(query_fps, threshold)
+            compared += self.last_compared
+            results.append((molecules.molecule_list[i].name, [(self.names[j], sim) for (j, sim) in hits]))
+        self.last_compared = compared
+        return results
+
+    # save the index to a numpy .npz file
+    def save(self, path):
+        fps = self.fingerprints
+        fp_type = self.fp_type if self.fp_type else Fingerprints.default_fp_type
+        np.savez(path, names=np.array(self.names, dtype=str), words=fps.words,
+                 counts=fps.counts, sizes=fps.sizes, nbits=fps.nbits,
+                 fp_type=np.array(fp_type))
+        logger.info("Saved similarity index of {} molecules to \"{}\"".format(len(self.names), path))
+
+    # load an index saved by save
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path, allow_pickle=False) as data:
+            # indexes from before the fingerprint types have no fp_type (rdkit)
+            index.fp_type = str(data["fp_type"]) if "fp_type" in data.files else Fingerprints.default_fp_type
+            fps = Fingerprints.PackedFingerprints(int(data["nbits"]))
+            (fps._words, fps._counts, fps._sizes) = (data["words"], data["counts"], data["sizes"])
+            fps._length = len(fps._counts)
+            index._build(fps, data["names"].tolist())
+        logger.info("Loaded similarity index of {} molecules from \"{}\"".format(len(index), path))
+        return index
@@ -7,8 +7,11 @@ Part of the IBRI cheminformatics system
 
 test the utility functions for accessing chembl information
 """
+from pathlib import Path
 from data.db import db_chembl
+from data import core_utils
 import json
+import psycopg2
 import logging
 
 # create logger
@@ -57,6 +60,7 @@ _test_assay_id_list_lg = ['CHEMBL904416', 'CHEMBL904417', 'CHEMBL939816', 'CHEMB
                           'CHEMBL1052162', 'CHEMBL1052166', 'CHEMBL1226577', 'CHEMBL1226583', 'CHEMBL1226716',
                           'CHEMBL1249424', 'CHEMBL1249425', 'CHEMBL1249426', 'CHEMBL1249427', 'CHEMBL1249428' ]
 _test_accession_id = 'Q13936'
+_test_tmp_export_file_ = str(Path(__file__).parent.parent / 'test_data/tmp/activities.csv')
 _test_accession_id_list = ['Q13936', 'P07948']
 
 def test_database_selections():
@@ -74,17 +78,19 @@ def test_database_selections():
 # test the interface for simple calls
 def test_db_connection():
     _test_name = 'test_db_connection'
-    # check get connector
-    db_conn = db_chembl._get_db_connector()
-    assert db_conn != None
+    # check get pool
+    db_pool = db_chembl._get_db_pool()
+    assert db_pool != None
 
-    # check get same connector second time
-    db_conn_2 = db_chembl._get_db_connector()
-    assert db_conn == db_conn_2
+    # check get same pool second time
+    db_pool_2 = db_chembl._get_db_pool()
+    assert db_pool == db_pool_2
 
-    # make sure cursor is defined
-    db_cur = db_chembl._get_db_cursor()
-    assert db_conn != None
+    # make sure connection and cursor are defined
+    with db_chembl.db_connection() as db_conn:
+        assert db_conn != None
+    with db_chembl.db_cursor() as db_cur:
+        assert db_cur != None
 
     # check connections and tables
     version = db_chembl._db_execute('SELECT version();')
@@ -108,9 +114,6 @@ def test_db_connection():
 
 def test_utility_functions():
     """ test the utility functions """
-    ids_str = db_chembl._ids_to_str_list(['0','1','2'])
-    assert ids_str == "'0','1','2'"
-
     _test_structured = {
         'fields' : ['field_1', 'field_2'],
         'values' : [
@@ -318,3 +321,140 @@ def test_activities_queries():
 
     # Force debug listing
     #assert True == False
+
+def test_activities_streaming():
+    _assay_id_list = list(_assay_id_to_chembl_id.keys())
+    activities = list(db_chembl.iter_activities_from_assay_ids(_assay_id_list))
+    assert len(activities) == 54
+    assert type(activities[0]) == type(dict())
+
+    activities = list(db_chembl.iter_activities_from_molregnos(_test_molregno_list, batch_size=10))
+    assert len(activities) == 47
+
+    batches = list(db_chembl.iter_activities_from_molregnos(_test_molregno_list, batch_size=10, batches=True))
+    assert [len(batch) for batch in batches] == [10, 10, 10, 10, 7]
+
+    # errors are raised rather than ending the stream early
+    raised = False
+    try:
+        list(db_chembl._db_execute_iter('select 1 / (molregno - {}) from activities'.format(_test_molregno_list[1])))
+    except psycopg2.Error:
+        raised = True
+    assert raised
+    activities = list(db_chembl.iter_activities_from_molregnos(_test_molregno_list))
+    assert len(activities) == 47
+
+def test_pooled_queries():
+    _test_name = 'test_pooled_queries'
+    with db_chembl.db_cursor() as cur:
+        assert cur != None
+        cur.execute('SELECT version();')
+        assert len(cur.fetchall()) == 1
+
+    # results come back in the order of the items
+    results = db_chembl.parallel_queries(db_chembl.activities_from_molregnos, _test_molregno_list, threads=2)
+    assert [len(result) for result in results] == [8, 39]
+
+    results = db_chembl.parallel_queries(db_chembl.tids_from_chembl_ids, list(_tgt_chembl_id_to_tid.keys()))
+    for (chembl_id, result) in zip(_tgt_chembl_id_to_tid.keys(), results):
+        assert result == {chembl_id : _tgt_chembl_id_to_tid[chembl_id]}
+
+def test_failed_lookups():
+    _test_name = 'test_failed_lookups'
+    from bin import ade_get_target_data
+    # a failed query is None rather than no results
+    for module in [db_chembl, ade_get_target_data.db_chembl]:
+        execute = module._db_execute
+        module._db_execute = lambda sql_statement, fields=None, params=None: None
+        try:
+            assert module.tids_from_chembl_ids(list(_tgt_chembl_id_to_tid.keys())) == None
+            assert module.assay_ids_from_tids(list(_tgt_tid_to_chembl_id.keys())) == None
+            assert module.activities_from_molregnos(_test_molregno_list) == None
+            assert module.assay_details_from_assay_ids(list(_assay_id_to_chembl_id.keys())) == None
+        finally:
+            module._db_execute = execute
+    assert db_chembl.tids_from_chembl_ids(['no_such_id']) == {}
+
+    # the target records of a failed lookup are not mistaken for no activities
+    target_id = list(_tgt_chembl_id_to_tid.keys())[0]
+    records = ade_get_target_data.chembl_target_records(target_id)
+    assert records != None
+    module = ade_get_target_data.db_chembl
+    execute = module._db_execute
+    module._db_execute = lambda sql_statement, fields=None, params=None: None if 'from assays' in sql_statement else execute(sql_statement, fields, params)
+    try:
+        assert ade_get_target_data.chembl_target_records(target_id) == None
+    finally:
+        module._db_execute = execute
+
+def test_schema_cache():
+    _test_name = 'test_schema_cache'
+    db_chembl.invalidate_schema_cache()
+    columns = db_chembl.get_table_columns('target_dictionary')
+    assert len(columns) == 7
+    assert columns[0] == 'tid'
+    assert db_chembl.get_table_columns('target_dictionary') is columns
+
+    # fields follow the query, not the table
+    data = db_chembl._db_execute_structured('SELECT tid, chembl_id from target_dictionary', 'target_dictionary', 10)
+    assert data['fields'] == ['tid', 'chembl_id']
+    assert len(data['values']) == 10
+
+    db_chembl.invalidate_schema_cache()
+    assert db_chembl.get_table_columns('target_dictionary') is not columns
+
+def test_id_arrays():
+    _test_name = 'test_id_arrays'
+    assert list(db_chembl._ids_to_arrays(['0', 1])) == ['{"0","1"}']
+    assert list(db_chembl._ids_to_arrays(['a"b'])) == ['{"a\\"b"}']
+    assert len(list(db_chembl._ids_to_arrays(list(range(0, 5)), 2))) == 3
+    assert list(db_chembl._ids_to_arrays([])) == []
+
+    # chunked lookups give the same results
+    chunk = db_chembl._id_chunk_
+    db_chembl._id_chunk_ = 1
+    try:
+        activities = db_chembl.activities_from_molregnos(_test_molregno_list)
+        assert len(activities) == 47
+        molregnos = db_chembl.molregnos_from_chembl_ids(list(_cpd_chembl_id_to_molregno.keys()))
+        assert molregnos == _cpd_chembl_id_to_molregno
+    finally:
+        db_chembl._id_chunk_ = chunk
+
+def test_export_activities():
+    _test_name = 'test_export_activities'
+    written = db_chembl.export_activities(_test_tmp_export_file_, _test_molregno_list)
+    assert written == 47
+    rows = core_utils.read_csv_as_dict(_test_tmp_export_file_)
+    assert len(rows) == 47
+    assert 'molecule_chembl_id' in rows[0]
+    assert 'standard_value' in rows[0]
+    core_utils.remove_file(_test_tmp_export_file_)
+
+    _assay_id_list = list(_assay_id_to_chembl_id.keys())
+    assert db_chembl.export_activities(_test_tmp_export_file_, _assay_id_list, 'assay_id') == 54
+    core_utils.remove_file(_test_tmp_export_file_)
+
+    assert db_chembl.export_activities(_test_tmp_export_file_, _test_molregno_list, 'error') == None
+
+    if core_utils.pyarrow != None:
+        parquet_file = _test_tmp_export_file_ + '.parquet'
+        assert db_chembl.export_activities(parquet_file, _test_molregno_list, fmt='parquet') == 47
+        assert core_utils.pyarrow.parquet.read_table(parquet_file).num_rows == 47
+        core_utils.remove_file(parquet_file)
+
+        # a chunk failing after the first was written leaves no file
+        execute_iter = db_chembl._db_execute_iter
+        def failing_iter(sql_statement, batch_size, fields, params, types):
+            yield from execute_iter(sql_statement, batch_size, fields, params, types)
+            if params[0] != '{{"{}"}}'.format(_test_molregno_list[0]):
+                raise psycopg2.OperationalError("test failure")
+        chunk = db_chembl._id_chunk_
+        db_chembl._id_chunk_ = 1
+        db_chembl._db_execute_iter = failing_iter
+        try:
+            assert db_chembl.export_activities(parquet_file, _test_molregno_list, fmt='parquet') == None
+            assert not core_utils.file_exists(parquet_file)
+        finally:
+            db_chembl._db_execute_iter = execute_iter
+            db_chembl._id_chunk_ = chunk
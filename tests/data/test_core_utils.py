@@ -130,3 +130,45 @@ def test_get_csvwriter():
     """ test getting csvwriter """
     csvwriter = core_utils.get_csvwriter("")
     assert csvwriter
+
+def test_open_text_file():
+    """ test opening plain and compressed text files """
+    for suffix in ['', '.gz', '.bz2']:
+        my_file = _test_content_file_ + suffix
+        with core_utils.open_text_file(my_file, 'w') as file_ref:
+            file_ref.write(_test_content_)
+        with core_utils.open_text_file(my_file) as file_ref:
+            assert file_ref.read() == _test_content_
+        core_utils.remove_file(my_file)
+        assert core_utils.file_exists(my_file) == False
+
+def test_row_writer():
+    """ test the streaming row writer formats """
+    rows = [('a', 'b', 0.5), ('c', None, None)]
+    my_file = _test_content_file_ + '.csv'
+    with core_utils.RowWriter(my_file, ['mol1', 'mol2', 'similarity'], fmt="csv") as writer:
+        writer.writerows(rows[:1])
+        writer.writerows(rows[1:])
+    assert writer.rows_written == 2
+    with open(my_file) as file_ref:
+        assert list(csv.reader(file_ref)) == [['mol1', 'mol2', 'similarity'], ['a', 'b', '0.5'], ['c', '', '']]
+    with core_utils.RowWriter(my_file, ['mol1', 'mol2', 'similarity'], fmt="text") as writer:
+        writer.writerows(rows)
+    assert core_utils.read_text_from_file(my_file) == "mol1 mol2 similarity\na b 0.5\nc None None\n"
+    # no header without results
+    with core_utils.RowWriter(my_file, ['mol1', 'mol2', 'similarity'], fmt="csv") as writer:
+        writer.writerows([])
+    assert core_utils.read_text_from_file(my_file) == ""
+    core_utils.remove_file(my_file)
+    if core_utils.pyarrow != None:
+        my_file = _test_content_file_ + '.parquet'
+        with core_utils.RowWriter(my_file, ['mol1', 'mol2', 'similarity'], ['string', 'string', 'float64'], fmt="parquet") as writer:
+            writer.writerows(rows)
+        table = core_utils.pyarrow.parquet.read_table(my_file)
+        assert table.column('similarity').to_pylist() == [0.5, None]
+        core_utils.remove_file(my_file)
+    try:
+        core_utils.RowWriter(None, ['mol1'], fmt="error")
+        assert False
+    except ValueError:
+        pass
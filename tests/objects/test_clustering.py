@@ -0,0 +1,99 @@
+"""
+test_clustering.py
+------------
+Author: Daniel H Robertson
+
+Part of the IBRI cheminformatics system
+
+test the clustering against rdkit Butina and a plain leader loop
+"""
+import logging
+from pathlib import Path
+import numpy as np
+from rdkit import Chem
+from rdkit import DataStructs
+from rdkit.ML.Cluster import Butina
+from objects import Fingerprints
+from objects import Clustering
+
+_test_smi_files_ = [str(Path(__file__).parent / 'data/test_read.smi'), str(Path(__file__).parent / 'data/test_read_2.smi')]
+
+logger = logging.getLogger()
+logger.level = logging.ERROR
+
+def _read_fps():
+    mols = list()
+    for smi_file in _test_smi_files_:
+        with open(smi_file) as file_ref:
+            for line in file_ref:
+                mols.append(Chem.MolFromSmiles(line.split(' ')[0]))
+    return Fingerprints.fingerprint_mols(mols, 'morgan')
+
+def _packed(fps):
+    store = Fingerprints.PackedFingerprints(Fingerprints.fingerprint_bits('morgan'))
+    store.extend(fps)
+    return store
+
+def test_neighbour_lists():
+    """ test the tiled neighbour lists """
+    fps = _read_fps()
+    (indptr, indices) = Clustering.neighbour_lists(_packed(fps), 0.6, tile=3)
+    for i in range(0, len(fps)):
+        sims = DataStructs.BulkTanimotoSimilarity(fps[i], fps)
+        expected = [j for j in range(0, len(fps)) if j != i and 1.0 - sims[j] <= 0.6]
+        assert indices[indptr[i]:indptr[i+1]].tolist() == expected
+
+def test_butina_clusters():
+    """ test the butina clusters match rdkit """
+    fps = _read_fps()
+    dists = list()
+    for i in range(1, len(fps)):
+        dists.extend([1.0 - sim for sim in DataStructs.BulkTanimotoSimilarity(fps[i], fps[:i])])
+    for threshold in [0.4, 0.6, 0.8]:
+        expected = Butina.ClusterData(dists, len(fps), threshold, isDistData=True)
+        (cluster_ids, centroids) = Clustering.butina_clusters(_packed(fps), threshold)
+        assert centroids == [cluster[0] for cluster in expected]
+        for (c, cluster) in enumerate(expected):
+            assert sorted(cluster) == np.nonzero(cluster_ids == c)[0].tolist()
+
+def test_leader_clusters():
+    """ test the blocked leader clusters against a plain loop """
+    fps = _read_fps()
+    for threshold in [0.5, 0.7]:
+        centroids = list()
+        cluster_ids = list()
+        for i in range(0, len(fps)):
+            sims = [DataStructs.TanimotoSimilarity(fps[i], fps[c]) for c in centroids]
+            if len(sims) and 1.0 - max(sims) <= threshold:
+                cluster_ids.append(sims.index(max(sims)))
+            else:
+                cluster_ids.append(len(centroids))
+                centroids.append(i)
+        for block in [3, 4096]:
+            result = Clustering.leader_clusters(_packed(fps), threshold, block=block)
+            assert result[0].tolist() == cluster_ids
+            assert result[1] == centroids
+
+def test_maxmin_pick():
+    """ test the MaxMin picks against a plain loop """
+    fps = _read_fps()
+    def plain_picks(n_picks, picked):
+        picks = list()
+        while len(picks) < n_picks:
+            best = (-1.0, None)
+            for i in range(0, len(fps)):
+                if i in picked:
+                    continue
+                dist = min([1.0 - DataStructs.TanimotoSimilarity(fps[i], fps[p]) for p in picked]) if len(picked) else 0.0
+                if dist > best[0]:
+                    best = (dist, i)
+            picks.append(best[1])
+            picked = picked + [best[1]]
+        return picks
+    store = _packed(fps)
+    assert Clustering.maxmin_pick(store, 6) == [0] + plain_picks(5, [0])
+    assert Clustering.maxmin_pick(store, 5, seeds=[3, 7]) == plain_picks(5, [3, 7])
+    # seeds from another selection
+    seed_fps = store.take(np.array([3, 7]))
+    assert Clustering.maxmin_pick(store, 5, seed_fps=seed_fps) == plain_picks(5, [3, 7])
+    assert len(Clustering.maxmin_pick(store, len(fps) + 5, seeds=[0])) == len(fps) - 1
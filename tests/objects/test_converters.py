@@ -0,0 +1,90 @@
+"""
+test_converters.py
+------------
+Author: Daniel H Robertson
+
+Part of the IBRI cheminformatics system
+
+test the streaming file conversions
+"""
+import io
+import os
+import gzip
+import logging
+from pathlib import Path
+from rdkit import Chem
+from objects import Converters
+
+_test_smi_file_ = str(Path(__file__).parent / 'data/test_read.smi')
+_test_smi_tmp_file_ = str(Path(__file__).parent / 'data/tmp/test_convert.smi')
+_test_sdf_tmp_file_ = str(Path(__file__).parent / 'data/tmp/test_convert.sdf')
+
+logger = logging.getLogger()
+logger.level = logging.ERROR
+
+def _read_smi():
+    with open(_test_smi_file_) as file_ref:
+        return [line.rstrip('\n').split(' ')[:2] for line in file_ref]
+
+def test_smi_to_sdf():
+    """ test the smiles to sdf conversion serial and on a pool """
+    records = _read_smi()
+    assert Converters.smi_to_sdf(_test_smi_file_, _test_sdf_tmp_file_, "ID") == (len(records), 0)
+    mols = [mol for mol in Chem.SDMolSupplier(_test_sdf_tmp_file_)]
+    assert [mol.GetProp("ID") for mol in mols] == [record[1] for record in records]
+    for (mol, record) in zip(mols, records):
+        assert Chem.MolToSmiles(mol) == Chem.MolToSmiles(Chem.MolFromSmiles(record[0]))
+        assert mol.GetConformer().GetAtomPosition(0).x != 0.0 or mol.GetConformer().GetAtomPosition(1).x != 0.0
+    # unnamed and bad records, compressed output, pool and no coordinates
+    with open(_test_smi_tmp_file_, 'w') as file_ref:
+        file_ref.write("n1cccc1 bad\n")
+        for record in records:
+            file_ref.write("{}\n".format(record[0]))
+    gz_file = _test_sdf_tmp_file_ + '.gz'
+    result = Converters.smi_to_sdf(_test_smi_tmp_file_, gz_file, "ID", coords=False, chunk_size=3, processes=2)
+    assert result == (len(records), 1)
+    with gzip.open(gz_file) as file_ref:
+        gz_mols = [mol for mol in Chem.ForwardSDMolSupplier(file_ref)]
+    assert [mol.GetProp("ID") for mol in gz_mols] == ["mol_name_{:05d}".format(i) for i in range(0, len(records))]
+    assert [Chem.MolToSmiles(mol) for mol in gz_mols] == [Chem.MolToSmiles(mol) for mol in mols]
+    assert gz_mols[0].GetConformer().GetAtomPosition(0).x == 0.0
+    unordered = Converters.smi_to_sdf(_test_smi_tmp_file_, _test_sdf_tmp_file_, "ID", chunk_size=3, processes=2, ordered=False)
+    assert unordered == (len(records), 1)
+    assert Converters.smi_to_sdf('not_a_file.smi', _test_sdf_tmp_file_) == None
+    # chunked output is the file a single SDWriter writes -- record numbers run on
+    Converters.smi_to_sdf(_test_smi_file_, _test_sdf_tmp_file_, "ID", coords=False, chunk_size=3, processes=2)
+    stream = io.StringIO()
+    writer = Chem.SDWriter(stream)
+    writer.SetProps(["ID"])
+    for (smiles, name) in records:
+        rd_mol = Chem.MolFromSmiles(smiles)
+        conformer = Chem.Conformer(rd_mol.GetNumAtoms())
+        conformer.Set3D(False)
+        rd_mol.AddConformer(conformer)
+        rd_mol.SetProp("ID", name)
+        writer.write(rd_mol)
+    writer.close()
+    with open(_test_sdf_tmp_file_) as file_ref:
+        assert file_ref.read() == stream.getvalue()
+    for tmp_file in [_test_smi_tmp_file_, _test_sdf_tmp_file_, gz_file]:
+        os.remove(tmp_file)
+
+def test_sdf_to_smi():
+    """ test the sdf to smiles conversion single and multithreaded """
+    records = _read_smi()
+    Converters.smi_to_sdf(_test_smi_file_, _test_sdf_tmp_file_, "Catalog ID")
+    gz_file = _test_sdf_tmp_file_ + '.gz'
+    with open(_test_sdf_tmp_file_, 'rb') as file_ref, gzip.open(gz_file, 'wb') as gz_ref:
+        gz_ref.write(file_ref.read())
+    expected = ["{} {}".format(Chem.MolToSmiles(Chem.MolFromSmiles(smiles)), name) for (smiles, name) in records]
+    for (in_file, threads) in [(_test_sdf_tmp_file_, 1), (_test_sdf_tmp_file_, 3), (gz_file, 1), (gz_file, 2)]:
+        assert Converters.sdf_to_smi(in_file, _test_smi_tmp_file_, "Catalog ID", threads) == (len(records), 0)
+        with open(_test_smi_tmp_file_) as file_ref:
+            assert file_ref.read().splitlines() == expected
+    # unordered returns the same molecules, missing names are skipped
+    Converters.sdf_to_smi(_test_sdf_tmp_file_, _test_smi_tmp_file_, "Catalog ID", 3, ordered=False)
+    with open(_test_smi_tmp_file_) as file_ref:
+        assert sorted(file_ref.read().splitlines()) == sorted(expected)
+    assert Converters.sdf_to_smi(_test_sdf_tmp_file_, _test_smi_tmp_file_, "error") == (0, len(records))
+    for tmp_file in [_test_smi_tmp_file_, _test_sdf_tmp_file_, gz_file]:
+        os.remove(tmp_file)
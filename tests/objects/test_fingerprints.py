@@ -0,0 +1,108 @@
+"""
+test_fingerprints.py
+------------
+Author: Daniel H Robertson
+
+Part of the IBRI cheminformatics system
+
+test the packed fingerprints and tanimoto kernels
+"""
+import logging
+from pathlib import Path
+import numpy as np
+from rdkit import Chem
+from rdkit import DataStructs
+from rdkit.Chem.Fingerprints import FingerprintMols
+from objects import Fingerprints
+
+_test_smi_file_ = str(Path(__file__).parent / 'data/test_read.smi')
+# small molecules get folded to shorter fingerprints
+_test_smiles_small_ = ['C1=CC=CN=C1', 'CCO', 'n1cnccc1C']
+
+logger = logging.getLogger()
+logger.level = logging.ERROR
+
+def _read_fps():
+    smiles = list()
+    with open(_test_smi_file_) as file_ref:
+        for line in file_ref:
+            smiles.append(line.split(' ')[0])
+    smiles += _test_smiles_small_
+    return [FingerprintMols.FingerprintMol(Chem.MolFromSmiles(smi)) for smi in smiles]
+
+def test_packed_fingerprints():
+    """ test the packed store """
+    fps = _read_fps()
+    store = Fingerprints.PackedFingerprints()
+    assert len(store) == 0
+    store.extend(fps)
+    assert len(store) == len(fps)
+    assert store.words.shape == (len(fps), 32)
+    for i in range(0, len(fps)):
+        assert store.counts[i] == fps[i].GetNumOnBits()
+        assert store.sizes[i] == fps[i].GetNumBits()
+    sub = store.take(slice(2, 5))
+    assert len(sub) == 3
+    assert sub.counts[0] == store.counts[2]
+    # fold matches rdkit
+    folded = Fingerprints.fold_words(store.words[:1], 2048, 256)
+    rd_folded = DataStructs.FoldFingerprint(fps[0], 8)
+    assert (folded[0] == Fingerprints.fp_to_words(rd_folded)).all()
+
+def test_tanimoto():
+    """ test the kernels against the rdkit similarities """
+    fps = _read_fps()
+    store = Fingerprints.PackedFingerprints()
+    store.extend(fps)
+    sims = Fingerprints.tanimoto_many_to_many(store, store)
+    assert sims.shape == (len(fps), len(fps))
+    for i in range(0, len(fps)):
+        for j in range(0, len(fps)):
+            assert sims[i, j] == DataStructs.FingerprintSimilarity(fps[i], fps[j])
+    row = Fingerprints.tanimoto_one_to_many(store, -1, store)
+    assert (row == sims[-1]).all()
+    assert Fingerprints.truncate(np.array([0.4949, 0.5]))[0] == 0.494
+
+def test_common_counts():
+    """ test the popcount and matrix product intersection counts agree """
+    rng = np.random.default_rng(0)
+    a_words = rng.integers(0, 2**63, size=(40, 32), dtype=np.uint64)
+    b_words = rng.integers(0, 2**63, size=(50, 32), dtype=np.uint64)
+    common = Fingerprints._common_counts(a_words, b_words)
+    assert common.shape == (40, 50)
+    assert (common[:10] == Fingerprints._common_counts(a_words[:10], b_words)).all()
+    assert common[3, 7] == Fingerprints._popcount(a_words[3] & b_words[7]).sum()
+
+def test_fingerprint_types():
+    """ test the registered fingerprint types against rdkit """
+    smiles = [smi for smi in _test_smiles_small_] + ['CC(=O)Oc1ccccc1C(=O)O', 'CN1CCC[C@H]1c1cccnc1']
+    mols = [Chem.MolFromSmiles(smi) for smi in smiles]
+    assert 'morgan' in Fingerprints.fingerprint_types()
+    for fp_type in ['rdkit', 'morgan', 'atompair', 'maccs']:
+        fps = Fingerprints.fingerprint_mols(mols, fp_type)
+        assert len(fps) == len(mols)
+        assert fps[0].GetNumBits() <= Fingerprints.fingerprint_bits(fp_type)
+        store = Fingerprints.PackedFingerprints(Fingerprints.fingerprint_bits(fp_type))
+        store.extend(fps)
+        sims = Fingerprints.tanimoto_many_to_many(store, store)
+        for i in range(0, len(fps)):
+            assert (store.counts[i] == fps[i].GetNumOnBits())
+            assert Fingerprints.words_to_fp(store.words[i], store.sizes[i]) == fps[i]
+            for j in range(0, len(fps)):
+                assert sims[i, j] == DataStructs.FingerprintSimilarity(fps[i], fps[j])
+    try:
+        Fingerprints.fingerprint_mol(mols[0], 'not_a_type')
+        assert False
+    except ValueError:
+        pass
+
+def test_superset_rows():
+    """ test the substructure screen keeps every molecule containing the query """
+    mols = [Chem.MolFromSmiles(smi) for smi in _test_smiles_small_ + ['c1ccccc1CCO', 'OCCc1ccncc1']]
+    store = Fingerprints.PackedFingerprints(Fingerprints.fingerprint_bits('pattern'))
+    store.extend(Fingerprints.fingerprint_mols(mols, 'pattern'))
+    query = Fingerprints.PackedFingerprints(Fingerprints.fingerprint_bits('pattern'))
+    query.append(Fingerprints.fingerprint_mol(Chem.MolFromSmarts('CCO'), 'pattern'))
+    rows = Fingerprints.superset_rows(query, 0, store).tolist()
+    assert 3 in rows and 4 in rows
+    assert 0 not in rows
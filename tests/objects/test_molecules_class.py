@@ -7,15 +7,24 @@ Part of the IBRI cheminformatics system
 
 test the Molecule list class
 """
+import os
 import pprint
 import logging
+import gzip
+import shutil
 from pathlib import Path
+import numpy as np
+from rdkit import Chem
 from objects import Molecules
+from data import core_utils
 
 _null_file_ = 'data/missing.smi' # should not exist
 _test_smi_file_ = str(Path(__file__).parent / 'data/test_read.smi')
 _test_smi_2_file_ = str(Path(__file__).parent / 'data/test_read_2.smi')
 _test_smi_tmp_file_ = str(Path(__file__).parent / 'data/tmp/test_read.smi')
+_test_save_tmp_dir_ = str(Path(__file__).parent / 'data/tmp/test_save')
+_test_smi_gz_tmp_file_ = str(Path(__file__).parent / 'data/tmp/test_read.smi.gz')
+_test_sdf_tmp_file_ = str(Path(__file__).parent / 'data/tmp/test_read.sdf')
 
 _test_smiles_1_ = 'C1=CC=CN=C1'
 _test_smiles_1_tup = (_test_smiles_1_, 'mol_1')
@@ -77,6 +86,25 @@ def test_read_write():
     # TODO: Add the ability to write
     logger.level = logging.ERROR
 
+def test_read_streaming():
+    """ test the streaming and compressed smiles readers """
+    records = list(Molecules.read_smi_records(_test_smi_file_))
+    assert len(records) == 10
+    assert records[0] == ('Cc1nc2cc(C3CCCN3Cc3ccc(Cl)cc3)nn2c(O)c1C', 'ADM_13086138')
+    chunks = list(Molecules.read_smi_chunks(_test_smi_file_, 4))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    with open(_test_smi_file_) as file_ref:
+        content = file_ref.read()
+    with gzip.open(_test_smi_gz_tmp_file_, 'wt') as file_ref:
+        file_ref.write(content)
+    assert list(Molecules.read_smi_records(_test_smi_gz_tmp_file_)) == records
+    molecules = Molecules.Molecules()
+    molecules.addFromSmiFile(_test_smi_gz_tmp_file_, chunk_size=3)
+    assert molecules.length() == 10
+    assert molecules.getMol(9)["name"] == 'ADM_13144165'
+    core_utils.remove_file(_test_smi_gz_tmp_file_)
+    logger.level = logging.ERROR
+
 def test_similarities():
     """ test the similarity functions """
     molecules = Molecules.Molecules()
@@ -102,3 +130,356 @@ def test_similarities():
     #print(pprint.pformat(inter_sim))
     #assert True == False
     logger.level = logging.ERROR
+
+def test_svg():
+    """ test the on demand svg depiction """
+    molecules = Molecules.Molecules()
+    molecules.addSmiles([_test_smiles_1_tup, _test_smiles_3_tup])
+    assert molecules.getMol(0)["svg"] == None
+    svg = molecules.getSvg(0)
+    assert svg.startswith("<?xml")
+    assert molecules.getMol(0)["svg"] == svg
+    assert molecules.getMol(1)["svg"] == None
+    assert molecules.getSvg(20) == None
+    # skip the depiction entirely
+    molecules = Molecules.Molecules(depict=False)
+    molecules.addSmiles(_test_smiles_1_tup)
+    assert molecules.getSvg(0) == None
+    assert molecules.getMol(0).svg == None
+    logger.level = logging.ERROR
+
+def test_similarity_arrays():
+    """ test the condensed and dense similarity matrices """
+    molecules = Molecules.Molecules()
+    molecules.addFromSmiFile(_test_smi_file_)
+    similarity_matrix = molecules.getIntraSimilarityMatrix()
+    (dense, names) = molecules.getIntraSimilarityMatrix(mode="dense")
+    assert dense.shape == (10, 10)
+    assert dense.dtype == np.float32
+    (condensed, names_2) = molecules.getIntraSimilarityMatrix(mode="condensed")
+    assert len(condensed) == 45
+    assert names == names_2
+    k = 0
+    for i in range(0, len(names)):
+        assert dense[i, i] == 1.0
+        for j in range(i+1, len(names)):
+            assert condensed[k] == dense[i, j] == dense[j, i]
+            assert abs(dense[i, j] - similarity_matrix[names[i]][names[j]]) < 1e-6
+            k += 1
+    assert molecules.getIntraSimilarityMatrix(mode="error") == None
+    logger.level = logging.ERROR
+
+def test_nearest():
+    """ test the top k nearest neighbour searches """
+    molecules = Molecules.Molecules()
+    molecules.addFromSmiFile(_test_smi_file_)
+    similarity_matrix = molecules.getIntraSimilarityMatrix()
+    # query with a molecule of the set
+    hits = molecules.nearest('COc1cc(CN2CCCCCC2c2ccn(C)n2)ccc1O', k=3)
+    assert len(hits) == 3
+    assert hits[0] == ('ADM_13142206', 1.0)
+    assert hits[1][1] == similarity_matrix['ADM_13142206'][hits[1][0]]
+    assert hits[1][1] >= hits[2][1]
+    assert len(molecules.nearest(_test_smiles_1_tup, k=3, threshold=0.99)) == 0
+    assert molecules.nearest(_test_smiles_error_) == None
+    # all against self -- excludes the molecule itself
+    nearest_all = molecules.nearestAll(k=4)
+    assert len(nearest_all) == 10
+    for (name_1, hits) in nearest_all:
+        assert len(hits) == 4
+        expected = sorted([similarity_matrix[name_1][name_2] for name_2 in similarity_matrix[name_1] if name_2 != name_1], reverse=True)
+        assert [sim for (name_2, sim) in hits] == expected[:4]
+        assert name_1 not in [name_2 for (name_2, sim) in hits]
+    # against a reference set with threshold
+    molecules_2 = Molecules.Molecules()
+    molecules_2.addFromSmiFile(_test_smi_2_file_)
+    nearest_all = molecules.nearestAll(k=20, mol_ref=molecules_2, threshold=0.45)
+    assert nearest_all[0][0] == 'ADM_13086138'
+    assert nearest_all[0][1][0] == ('SYN_18547648', 0.49)
+    for (name_1, hits) in nearest_all:
+        assert len(hits) <= 10
+        for (name_2, sim) in hits:
+            assert sim >= 0.45
+    # a molecule changed directly in molecule_list
+    assert molecules.nearest('CCO')[0][1] < 1.0
+    molecules.molecule_list[3] = Molecules.Molecule('ethanol', 'CCO', Chem.MolFromSmiles('CCO'))
+    molecules.getFingerprints('morgan')
+    molecules.invalidateCaches()
+    assert molecules.nearest('CCO') == [('ethanol', 1.0)]
+    assert molecules.nearest('CCO', fp_type='morgan') == [('ethanol', 1.0)]
+    logger.level = logging.ERROR
+
+def test_parallel_similarities():
+    """ test the process pool similarities match the serial ones """
+    molecules = Molecules.Molecules()
+    molecules.addFromSmiFile(_test_smi_file_)
+    molecules_2 = Molecules.Molecules()
+    molecules_2.addFromSmiFile(_test_smi_2_file_)
+    assert molecules.getInterSimilarities(molecules_2, processes=2) == molecules.getInterSimilarities(molecules_2)
+    assert molecules.getIntraSimilarities(processes=2) == molecules.getIntraSimilarities()
+    assert molecules.nearestAll(k=3, processes=2) == molecules.nearestAll(k=3)
+    logger.level = logging.ERROR
+
+def test_parallel_add():
+    """ test the process pool smiles parsing """
+    smiles = [_test_smiles_1_tup, _test_smiles_error_tup, _test_smiles_2_, _test_smiles_3_tup, _test_smiles_error_]
+    molecules = Molecules.Molecules()
+    errors = molecules.addSmiles(smiles)
+    molecules_2 = Molecules.Molecules()
+    errors_2 = molecules_2.addSmiles(smiles, processes=2, chunk_size=2)
+    assert errors == errors_2 == [_test_smiles_error_tup, (_test_smiles_error_, 'mol_name_00001')]
+    assert molecules.getAllSmilesList() == molecules_2.getAllSmilesList()
+    assert molecules_2.getMol(0)["smiles"] == 'c1ccncc1'
+    assert molecules_2.getMol(1)["name"] == 'mol_name_00000'
+    molecules_3 = Molecules.Molecules()
+    molecules_3.addFromSmiFile(_test_smi_file_, processes=2)
+    assert molecules_3.length() == 10
+    assert molecules_3.getIntraSimilarities()[6] == 'ADM_13142258 ADM_13142206 0.969'
+    logger.level = logging.ERROR
+
+def test_save_load():
+    """ test saving and loading the processed molecules """
+    molecules = Molecules.Molecules()
+    molecules.addFromSmiFile(_test_smi_file_)
+    molecules.addSmiles([_test_smiles_1_, _test_smiles_3_tup])
+    molecules.save(_test_save_tmp_dir_)
+    assert Molecules.Molecules.load(_null_file_) == None
+    for mmap in [True, False]:
+        molecules_2 = Molecules.Molecules.load(_test_save_tmp_dir_, mmap=mmap)
+        assert molecules_2.length() == 12
+        # mols and fingerprints are read on first access
+        assert molecules_2.getMol(0)._mol == None
+        assert molecules_2.getMol(0)._fp == None
+        assert molecules_2.getAllSmilesList() == molecules.getAllSmilesList()
+        assert molecules_2.getIntraSimilarities() == molecules.getIntraSimilarities()
+        for i in range(0, molecules.length()):
+            assert Chem.MolToSmiles(molecules_2.getMol(i)["mol"]) == molecules.getMol(i)["smiles"]
+            assert molecules_2.getMol(i)["fp"] == molecules.getMol(i)["fp"]
+        # can still add to a loaded set
+        molecules_2.addSmiles(_test_smiles_2_)
+        assert molecules_2.length() == 13
+        assert molecules_2.getMol(-1)["name"] == "mol_name_00001"
+    # a memory mapped set saved back over its own files
+    molecules_2 = Molecules.Molecules.load(_test_save_tmp_dir_)
+    molecules_2.addSmiles(_test_smiles_2_)
+    molecules_2.save(_test_save_tmp_dir_)
+    molecules_3 = Molecules.Molecules.load(_test_save_tmp_dir_)
+    assert molecules_3.length() == 13
+    assert (molecules_3.fingerprints.words == molecules_2.fingerprints.words).all()
+    assert molecules_3.getAllSmilesList() == molecules_2.getAllSmilesList()
+    assert molecules_3.getIntraSimilarities() == molecules_2.getIntraSimilarities()
+    shutil.rmtree(_test_save_tmp_dir_)
+    logger.level = logging.ERROR
+
+def test_molecule_records():
+    """ test the molecule records and iteration """
+    molecules = Molecules.Molecules()
+    molecules.addSmiles([_test_smiles_1_tup, _test_smiles_2_, _test_smiles_3_tup])
+    assert len(molecules) == 3
+    names = [mol.name for mol in molecules]
+    assert names == ['mol_1', 'mol_name_00000', 'mol_3']
+    mol = molecules.getMol(0)
+    assert type(mol) == Molecules.Molecule
+    assert not hasattr(mol, '__dict__')
+    assert mol.smiles == mol["smiles"] == 'c1ccncc1'
+    assert mol.mol is mol["mol"]
+    assert mol.fp is mol["fp"]
+    assert mol["svg"] == None
+    assert mol.svg == mol["svg"]
+    try:
+        mol["error"]
+        assert False
+    except KeyError:
+        pass
+    logger.level = logging.ERROR
+
+def test_fingerprint_types():
+    """ test the set fingerprint type and cached fingerprints of other types """
+    molecules = Molecules.Molecules(fp_type='morgan')
+    molecules.addFromSmiFile(_test_smi_file_)
+    assert molecules.fp_type == 'morgan'
+    assert molecules.fingerprints.nbits == 1024
+    assert molecules.getFingerprints() is molecules.fingerprints
+    rdkit_fps = molecules.getFingerprints('rdkit')
+    assert len(rdkit_fps) == molecules.length()
+    assert molecules.getFingerprints('rdkit') is rdkit_fps
+    default = Molecules.Molecules()
+    default.addFromSmiFile(_test_smi_file_)
+    assert (rdkit_fps.words == default.fingerprints.words).all()
+    assert molecules.getIntraSimilarityMatrix(fp_type='rdkit') == default.getIntraSimilarityMatrix()
+    # getFingerprints extends the cached store as molecules are added
+    molecules.addSmiles([_test_smiles_3_tup])
+    assert len(molecules.getFingerprints('rdkit')) == molecules.length()
+    molecules.save(_test_save_tmp_dir_)
+    loaded = Molecules.Molecules.load(_test_save_tmp_dir_)
+    assert loaded.fp_type == 'morgan'
+    assert loaded.getMol(0).fp == molecules.getMol(0).fp
+    shutil.rmtree(_test_save_tmp_dir_)
+    # saves without an fp_type load as rdkit
+    default.save(_test_save_tmp_dir_)
+    meta_file = os.path.join(_test_save_tmp_dir_, "molecules.json")
+    meta = core_utils.read_json(meta_file)
+    del meta["fp_type"]
+    core_utils.write_json(meta_file, meta)
+    loaded = Molecules.Molecules.load(_test_save_tmp_dir_)
+    assert loaded.fp_type == 'rdkit'
+    assert loaded.getMol(0).fp == default.getMol(0).fp
+    shutil.rmtree(_test_save_tmp_dir_)
+    logger.level = logging.ERROR
+
+def test_identity_index():
+    """ test the identity hash index and matching """
+    molecules = Molecules.Molecules(depict=False)
+    molecules.addSmiles([_test_smiles_1_tup, _test_smiles_3_tup, ('Oc1ccccn1.[Na+].[Cl-]', 'mol_salt')])
+    index = molecules.getIdentityIndex()
+    assert index['c1ccncc1'] == [0]
+    assert molecules.findIdentical(_test_smiles_2_) == ['mol_1']
+    assert molecules.findIdentical('Oc1ccccn1') == []
+    assert molecules.findIdentical('Oc1ccccn1', 'fragment') == ['mol_salt']
+    assert molecules.findIdentical('O=c1cccc[nH]1', 'fragment') == []
+    assert molecules.findIdentical('O=c1cccc[nH]1', 'tautomer') == ['mol_salt']
+    assert molecules.findIdentical('Cc1ccncn1', 'inchikey') == ['mol_3']
+    assert molecules.getIdentityIndex('error') == None
+    # the index is extended as molecules are added
+    molecules.addSmiles([('c1ccncc1', 'mol_4')])
+    assert molecules.findIdentical(_test_smiles_1_) == ['mol_1', 'mol_4']
+    molecules_ref = Molecules.Molecules(depict=False)
+    molecules_ref.addFromSmiFile(_test_smi_file_)
+    molecules_ref.addSmiles([('Cc1ncncc1', 'ref_3')])
+    matches = molecules.matchIdentical(molecules_ref)
+    assert [match[0] for match in matches] == ['mol_1', 'mol_3', 'mol_salt', 'mol_4']
+    assert matches[0][1] == [] and matches[1][1] == ['ref_3']
+    assert molecules.matchIdentical(molecules_ref, 'inchikey', processes=2) == matches
+    # keys without building molecules -- "" for smiles that fail
+    records = [('c1ccncc1', 'a'), ('XXX', 'b'), ('Cc1ncncc1', 'c')]
+    keys = list(Molecules.iter_identity_keys(records, 'inchikey', chunk_size=2))
+    assert [key[0] for key in keys] == records
+    assert keys[1][1] == ""
+    assert keys[2][1] in molecules.getIdentityIndex('inchikey')
+    assert list(Molecules.iter_identity_keys(records, 'inchikey', processes=2, chunk_size=1)) == keys
+    logger.level = logging.ERROR
+
+def test_substructure_search():
+    """ test the screened substructure search against the plain matches """
+    molecules = Molecules.Molecules(depict=False)
+    molecules.addFromSmiFile(_test_smi_file_)
+    molecules.addFromSmiFile(_test_smi_2_file_)
+    for smarts in ['Cl', '[OH]', 'C(=O)N', '[a;r5]', '[#7,#8]~[#6]~[#6]~[#7]']:
+        query = Chem.MolFromSmarts(smarts)
+        expected = [mol.name for mol in molecules if mol.mol.HasSubstructMatch(query)]
+        assert molecules.substructureSearch(smarts) == expected
+        assert molecules.substructureSearch(smarts, processes=2, chunk_size=4) == expected
+    assert len(molecules.substructureSearch('Cl')) == 2
+    assert molecules.substructureSearch('[C') == None
+    logger.level = logging.ERROR
+
+def test_cluster():
+    """ test clustering the set """
+    molecules = Molecules.Molecules(depict=False)
+    molecules.addFromSmiFile(_test_smi_file_)
+    molecules.addFromSmiFile(_test_smi_2_file_)
+    (cluster_ids, centroids) = molecules.cluster(0.4)
+    assert len(cluster_ids) == molecules.length()
+    assert (cluster_ids[centroids] == np.arange(len(centroids))).all()
+    (leader_ids, leaders) = molecules.cluster(0.4, method="leader")
+    assert leaders[0] == 0 and leader_ids[0] == 0
+    assert molecules.cluster(0.4, method="error") == None
+    logger.level = logging.ERROR
+
+def test_pick_diverse():
+    """ test diverse picks from the set """
+    molecules = Molecules.Molecules(depict=False)
+    molecules.addFromSmiFile(_test_smi_file_)
+    molecules.addFromSmiFile(_test_smi_2_file_)
+    picks = molecules.pickDiverse(4)
+    assert len(picks) == len(set(picks)) == 4
+    assert picks[0] == 0
+    selected = Molecules.Molecules(depict=False)
+    selected.addFromSmiFile(_test_smi_file_)
+    picks = molecules.pickDiverse(4, mol_ref=selected)
+    assert picks == molecules.pickDiverse(4, seeds=list(range(0, selected.length())))
+    logger.level = logging.ERROR
+
+def test_incremental_similarities():
+    """ test the cached similarities follow added and removed molecules """
+    molecules = Molecules.Molecules(depict=False)
+    molecules.addFromSmiFile(_test_smi_file_)
+    first = molecules.getIntraSimilarityMatrix(mode="dense", cache=True)[0]
+    molecules.addFromSmiFile(_test_smi_2_file_)
+    fresh = Molecules.Molecules(depict=False)
+    fresh.addFromSmiFile(_test_smi_file_)
+    fresh.addFromSmiFile(_test_smi_2_file_)
+    (dense, names) = molecules.getIntraSimilarityMatrix(mode="dense")
+    assert (dense[:len(first), :len(first)] == first).all()
+    assert (dense == fresh.getIntraSimilarityMatrix(mode="dense")[0]).all()
+    assert (molecules.getIntraSimilarityMatrix(mode="condensed")[0] == fresh.getIntraSimilarityMatrix(mode="condensed")[0]).all()
+    assert molecules.getIntraSimilarityMatrix() == fresh.getIntraSimilarityMatrix()
+    # only kept when asked for
+    assert len(molecules._similarity_cache) == 1 and len(fresh._similarity_cache) == 0
+    fresh.releaseSimilarityCache()
+    fresh.getIntraSimilarityMatrix(cache=True)
+    fresh.releaseSimilarityCache('rdkit')
+    assert len(fresh._similarity_cache) == 0
+    # removing molecules drops the cache
+    molecules.removeMolecules([0, 3, -1])
+    assert molecules.length() == fresh.length() - 3
+    assert len(molecules.fingerprints) == molecules.length()
+    keep = [i for i in range(0, fresh.length()) if i not in [0, 3, fresh.length() - 1]]
+    assert molecules.getIntraSimilarityMatrix(mode="dense")[0].tolist() == dense[np.ix_(keep, keep)].tolist()
+    assert molecules.getMol(0).name == names[1]
+    assert molecules.findIdentical(fresh.getMol(0).smiles) == []
+    logger.level = logging.ERROR
+
+def test_similarity_stats():
+    """ test the aggregate counters of the similarity calls """
+    molecules = Molecules.Molecules(depict=False)
+    molecules.addFromSmiFile(_test_smi_file_)
+    n = molecules.length()
+    molecules.getIntraSimilarities()
+    stats = molecules.similarity_stats
+    assert stats.pairs == n * n
+    assert stats.blocks >= 1 and stats.seconds >= 0
+    molecules.getIntraSimilarityMatrix(mode="condensed")
+    assert molecules.similarity_stats.pairs >= n * (n - 1) // 2
+    molecules.getIntraSimilarities(processes=2)
+    assert molecules.similarity_stats.pairs == n * n
+    logger.level = logging.ERROR
+
+def test_iter_similarities():
+    """ test the similarity generators match the lists """
+    molecules = Molecules.Molecules(depict=False)
+    molecules.addFromSmiFile(_test_smi_file_)
+    molecules_2 = Molecules.Molecules(depict=False)
+    molecules_2.addFromSmiFile(_test_smi_2_file_)
+    first = next(molecules.iterIntraSimilarities())
+    assert type(first[2]) == type(float())
+    assert "{} {} {}".format(*first) == molecules.getIntraSimilarities()[0]
+    assert ["{} {} {}".format(*s) for s in molecules.iterIntraSimilarities()] == molecules.getIntraSimilarities()
+    assert ["{} {} {}".format(*s) for s in molecules.iterInterSimilarities(molecules_2, processes=2)] == molecules.getInterSimilarities(molecules_2)
+    assert list(molecules.iterNearestAll(k=2)) == molecules.nearestAll(k=2)
+    logger.level = logging.ERROR
+
+def test_add_from_sdf():
+    """ test reading molecules from an sd file """
+    molecules = Molecules.Molecules(depict=False)
+    molecules.addFromSmiFile(_test_smi_file_)
+    writer = Chem.SDWriter(_test_sdf_tmp_file_)
+    for mol in molecules:
+        rd_mol = Chem.Mol(mol.mol)
+        rd_mol.SetProp("ID", mol.name)
+        writer.write(rd_mol)
+    writer.close()
+    for threads in [1, 2]:
+        sdf_molecules = Molecules.Molecules(depict=False)
+        sdf_molecules.addFromSdfFile(_test_sdf_tmp_file_, "ID", threads=threads, chunk_size=3)
+        assert [mol.name for mol in sdf_molecules] == [mol.name for mol in molecules]
+        assert sdf_molecules.getAllSmilesList() == molecules.getAllSmilesList()
+        assert (sdf_molecules.fingerprints.words == molecules.fingerprints.words).all()
+    # titles are used without an id field -- unnamed get the default names
+    sdf_molecules = Molecules.Molecules(depict=False)
+    sdf_molecules.addFromSdfFile(_test_sdf_tmp_file_)
+    assert sdf_molecules.getMol(0).name == "mol_name_00000"
+    assert sdf_molecules.addMols([None, Chem.MolFromSmiles('CCO')]) == [0]
+    assert sdf_molecules.getMol(-1).smiles == 'CCO'
+    os.remove(_test_sdf_tmp_file_)
+    logger.level = logging.ERROR
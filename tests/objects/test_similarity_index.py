@@ -0,0 +1,82 @@
+"""
+test_similarity_index.py
+------------
+Author: Daniel H Robertson
+
+Part of the IBRI cheminformatics system
+
+test the popcount bucketed similarity index
+"""
+import logging
+import numpy as np
+from pathlib import Path
+from data import core_utils
+from objects import Molecules
+from objects import SimilarityIndex
+
+_test_smi_file_ = str(Path(__file__).parent / 'data/test_read.smi')
+_test_smi_2_file_ = str(Path(__file__).parent / 'data/test_read_2.smi')
+_test_index_tmp_file_ = str(Path(__file__).parent / 'data/tmp/test_index.npz')
+# small molecules get folded to shorter fingerprints
+_test_smiles_small_ = ['C1=CC=CN=C1', 'CCO', 'n1cnccc1C', 'c1ccccc1O']
+
+logger = logging.getLogger()
+logger.level = logging.ERROR
+
+def _read_molecules():
+    molecules = Molecules.Molecules(depict=False)
+    molecules.addFromSmiFile(_test_smi_file_)
+    molecules.addFromSmiFile(_test_smi_2_file_)
+    molecules.addSmiles(_test_smiles_small_)
+    return molecules
+
+def test_bounds():
+    """ test the swamidass-baldi popcount bounds """
+    assert SimilarityIndex.popcount_bounds(100, 0.5) == (50, 200)
+    assert SimilarityIndex.popcount_bounds(100, 0.7) == (70, 142)
+    assert SimilarityIndex.popcount_bounds(100, 0)[0] == 0
+
+def test_search():
+    """ test the index search matches the full search """
+    molecules = _read_molecules()
+    index = SimilarityIndex.SimilarityIndex(molecules)
+    assert len(index) == molecules.length()
+    for threshold in [0.3, 0.5, 0.7, 0.9]:
+        for i in range(0, molecules.length()):
+            query = molecules.getMol(i)["smiles"]
+            hits = index.search(query, threshold)
+            expected = molecules.nearest(query, k=molecules.length(), threshold=threshold)
+            assert hits == expected
+            assert index.last_compared <= len(index)
+    # threshold searches skip most of the set
+    index.search(molecules.getMol(0)["smiles"], 0.9)
+    assert index.last_compared < len(index)
+    assert index.search('n1cccc1') == None
+    results = index.searchMolecules(molecules, 0.8)
+    assert len(results) == molecules.length()
+    assert results[0][1][0] == (results[0][0], 1.0)
+
+def test_save_load():
+    """ test the index persists """
+    molecules = _read_molecules()
+    index = SimilarityIndex.SimilarityIndex(molecules)
+    index.save(_test_index_tmp_file_)
+    index_2 = SimilarityIndex.SimilarityIndex.load(_test_index_tmp_file_)
+    assert len(index_2) == len(index)
+    query = molecules.getMol(3)["smiles"]
+    assert index_2.search(query, 0.5) == index.search(query, 0.5)
+    # indexes saved without an fp_type load as rdkit
+    with np.load(_test_index_tmp_file_) as data:
+        arrays = { key : data[key] for key in data.files if key != "fp_type" }
+    np.savez(_test_index_tmp_file_, **arrays)
+    index_3 = SimilarityIndex.SimilarityIndex.load(_test_index_tmp_file_)
+    assert index_3.fp_type == 'rdkit'
+    assert index_3.search(query, 0.5) == index.search(query, 0.5)
+    core_utils.remove_file(_test_index_tmp_file_)
+    # molecules added to the set after the build are not part of the index
+    molecules.addFromSmiFile(_test_smi_2_file_)
+    index.save(_test_index_tmp_file_)
+    index_4 = SimilarityIndex.SimilarityIndex.load(_test_index_tmp_file_)
+    assert len(index_4.fingerprints) == len(index_4) == len(index)
+    assert index_4.search(query, 0.0) == index.search(query, 0.0)
+    core_utils.remove_file(_test_index_tmp_file_)